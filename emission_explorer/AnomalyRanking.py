@@ -0,0 +1,198 @@
+import argparse
+import datetime as dt
+import warnings
+from pathlib import Path
+
+import geopandas as gpd
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+######local imports
+from emission_explorer.data_handler import config_file, query_data, create_reader, load_boundaries, prepare_output_folder
+
+
+def reference_windows(specific_dates, reference_start, reference_end):
+    """Returns the dates of the same days of 'specific_dates' in every year of the reference period (list of
+    DatetimeIndex, one per year fully contained in the reference period). 29 February becomes 28 February in the years
+    without it, or is missing (NaT) when 28 February is in the window too, so that it is not counted twice."""
+    windows = []
+    for year in range(reference_start.year, reference_end.year + 1):
+        shift = year - specific_dates[0].year
+        window = pd.DatetimeIndex([date + pd.DateOffset(years = shift) for date in specific_dates])
+        window = window.where(~window.duplicated())
+        if (window.dropna()[0] >= reference_start) and (window.dropna()[-1] <= reference_end):
+            windows.append(window)
+    return windows
+
+
+def anomaly_scores(specific, reference):
+    """Anomalies of the values 'specific' (any shape) with respect to the reference values on the last axis of
+    'reference' (same shape + one axis, e.g. region x day x year). Returns the ratio to the reference median, the
+    z-score (sample standard deviation) and the percentile rank (% of reference values <= the value)."""
+    n_valid = np.sum(np.isfinite(reference), axis = -1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # regions without reference values
+        median = np.nanmedian(reference, axis = -1)
+        mean = np.nanmean(reference, axis = -1)
+        std = np.nanstd(reference, axis = -1, ddof = 1)
+        ratio = np.where(median > 0, specific / median, np.nan)
+        zscore = np.where(std > 0, (specific - mean) / std, np.nan)
+        percentile = np.where((n_valid > 0) & np.isfinite(specific), np.sum(reference <= specific[..., None], axis = -1) / n_valid * 100, np.nan)
+    return median, ratio, zscore, percentile
+
+
+class AnomalyRanking(object):
+    """Ranks every Natural Earth unit and continent (see 'data_handler.load_boundaries') by how abnormal the fire
+    activity of the specific period of the config is, compared to the same days of every year of the reference period.
+
+    The daily values of all the regions are read with a single multi-region query per period ('extract_data_regions')
+    and kept as arrays (region x day, and region x day x year for the reference), so the anomalies of all the regions
+    are a few NumPy operations:
+     - 'period' mode: the values of the specific period are aggregated (summed for 'sum', maximum for 'max', minimum
+       for 'min', averaged otherwise) and compared with the same aggregate of every reference year.
+     - 'daily' mode: every day is compared with the same day of the reference years; the regions are ranked by their
+       maximum daily z-score and the daily anomalies are saved too.
+    The ranked table (csv) and a map of the z-scores of the countries are saved in the output folder.
+    """
+
+    def __init__(self,
+                 TOTAL_CONFIG: dict = None,
+                 mode: str = 'period',
+                 regions: str = 'all',
+                 db = None) -> None:
+        if mode not in ['period', 'daily']:
+            raise ValueError(f"The anomaly mode '{mode}' is not any of ['period', 'daily']")
+        if (TOTAL_CONFIG['reference_start_date'] == '') or (TOTAL_CONFIG['reference_end_date'] == ''):
+            raise ValueError('The anomalies need a reference period (reference_start_date and reference_end_date) in the config.')
+        self.TOTAL_CONFIG = TOTAL_CONFIG
+        self.mode = mode
+        self.db = db if db is not None else create_reader(TOTAL_CONFIG)
+        qd = query_data(TOTAL_CONFIG, run_query = False)
+        self.table_name = qd.get_table_name()
+        if not isinstance(self.table_name, str):
+            raise ValueError('The anomaly ranking is computed for a single variable.')
+
+        all_shapes = load_boundaries(file_path_location = None)
+        continents = set(all_shapes.continent.dropna())
+        is_continent = all_shapes.index.isin(continents)
+        if regions == 'countries':
+            all_shapes = all_shapes[~is_continent]
+        elif regions == 'continents':
+            all_shapes = all_shapes[is_continent]
+        self.shapes = all_shapes
+        self.is_continent = self.shapes.index.isin(continents)
+
+    def region_matrix(self, data, dates):
+        """(region x day) array of the daily values of 'data' (one column per region). Days without data are 0 for
+        'sum' (no fires), missing (NaN) for the other operations. The missing dates (NaT, see 'reference_windows') are NaN."""
+        fill_value = 0 if self.TOTAL_CONFIG['aggregating_operation'] == 'sum' else np.nan
+        data = data.reindex(index = dates, columns = self.shapes.index)
+        values = data.fillna(fill_value).values.T.astype(np.float64)
+        values[:, pd.isna(dates)] = np.nan
+        return values
+
+    def query(self, start_date, end_date):
+        regions = dict(zip(self.shapes.index, self.shapes.geometry))
+        return self.db.extract_data_regions(start_date, end_date, regions, self.table_name,
+                                            agg_operation = self.TOTAL_CONFIG['aggregating_operation'])
+
+    def compute(self):
+        """Runs the queries and returns the ranked table (and the daily anomalies in 'daily' mode)"""
+        config = self.TOTAL_CONFIG
+        specific_start = dt.datetime.strptime(config['specific_start_date'], '%d-%m-%Y')
+        specific_end = dt.datetime.strptime(config['specific_end_date'], '%d-%m-%Y')
+        reference_start = dt.datetime.strptime(config['reference_start_date'], '%d-%m-%Y')
+        reference_end = dt.datetime.strptime(config['reference_end_date'], '%d-%m-%Y')
+        specific_dates = pd.date_range(specific_start, specific_end, freq = 'D')
+        windows = reference_windows(specific_dates, pd.Timestamp(reference_start), pd.Timestamp(reference_end))
+        if not windows:
+            raise ValueError('The reference period does not contain the days of the specific period in any year.')
+
+        specific = self.region_matrix(self.query(specific_start, specific_end), specific_dates) # region x day
+        reference_data = self.query(reference_start, reference_end)
+        reference = self.region_matrix(reference_data, windows[0].append(windows[1:])) # region x (year, day)
+        reference = reference.reshape(len(self.shapes), len(windows), len(specific_dates)).transpose(0, 2, 1) # region x day x year
+
+        if self.mode == 'period':
+            aggregate = {'sum': np.nansum, 'max': np.nanmax, 'min': np.nanmin}.get(config['aggregating_operation'], np.nanmean)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                specific_period, reference_period = aggregate(specific, axis = 1), aggregate(reference, axis = 1)
+            median, ratio, zscore, percentile = anomaly_scores(specific_period, reference_period)
+            table = pd.DataFrame({'specific': specific_period, 'reference_median': median, 'ratio_to_median': ratio,
+                                  'zscore': zscore, 'percentile': percentile}, index = self.shapes.index)
+            self.daily = None
+        else:
+            median, ratio, zscore, percentile = anomaly_scores(specific, reference)
+            valid = np.isfinite(zscore)
+            day_max = np.argmax(np.where(valid, zscore, -np.inf), axis = 1)
+            has_zscore = valid.any(axis = 1)
+            finite_ratio = np.isfinite(ratio)
+            table = pd.DataFrame({'zscore': np.where(has_zscore, zscore[np.arange(len(zscore)), day_max], np.nan),
+                                  'day_max_zscore': pd.DatetimeIndex(specific_dates[day_max]).where(has_zscore),
+                                  'mean_ratio_to_median': np.where(finite_ratio, ratio, 0).sum(axis = 1) / np.where(finite_ratio.any(axis = 1), finite_ratio.sum(axis = 1), np.nan),
+                                  'days_zscore_above_2': np.sum(valid & (np.where(valid, zscore, 0) > 2), axis = 1)},
+                                 index = self.shapes.index)
+            self.daily = pd.DataFrame({'region': np.repeat(self.shapes.index.values, len(specific_dates)),
+                                       'datetime': np.tile(specific_dates.values, len(self.shapes)),
+                                       'value': specific.ravel(), 'reference_median': median.ravel(),
+                                       'ratio_to_median': ratio.ravel(), 'zscore': zscore.ravel(),
+                                       'percentile': percentile.ravel()})
+        table.index.name = 'region'
+        table.insert(0, 'continent', np.where(self.is_continent, 'continent', self.shapes.continent.fillna('').values))
+        table = table.sort_values('zscore', ascending = False, na_position = 'last')
+        table['rank'] = np.arange(1, len(table) + 1)
+        self.table = table
+        return table
+
+    def plot_map(self, ax = None):
+        """Map of the z-scores of the countries (the continents are only in the table)"""
+        if ax is None:
+            _, ax = plt.subplots(figsize = (12, 6))
+        countries = gpd.GeoDataFrame(self.table[self.table.continent != 'continent'][['zscore']],
+                                     geometry = self.shapes.geometry.reindex(self.table.index[self.table.continent != 'continent']),
+                                     crs = 'EPSG:4326')
+        vmax = np.nanmax(np.abs(countries.zscore.values)) if np.isfinite(countries.zscore.values).any() else 1
+        countries.boundary.plot(ax = ax, color = 'grey', lw = 0.2)
+        countries.dropna(subset = ['zscore']).plot('zscore', ax = ax, cmap = 'RdBu_r', vmin = -vmax, vmax = vmax, legend = True,
+                                                   legend_kwds = dict(label = 'z-score', shrink = 0.6))
+        config = self.TOTAL_CONFIG
+        ax.set_title(f"{config['variable']} - '{config['aggregating_operation']}' anomalies ({self.mode})\n"
+                     f"{config['specific_start_date']} to {config['specific_end_date']} vs {config['reference_start_date']} to {config['reference_end_date']}")
+        return ax
+
+    def save(self):
+        """Saves the ranked table, the daily anomalies ('daily' mode) and the map in the output folder"""
+        config = prepare_output_folder(self.TOTAL_CONFIG)
+        name = f"{self.table_name.replace('_data','')}_{self.mode}_from{config['specific_start_date']}to{config['specific_end_date']}"
+        output_folder = Path(config['output_folder'])
+        self.table.to_csv(output_folder / f'AnomalyRanking_{name}.csv')
+        if self.daily is not None:
+            self.daily.to_csv(output_folder / f'AnomalyDaily_{name}.csv', index = False)
+        ax = self.plot_map()
+        fig = ax.get_figure()
+        fig.tight_layout()
+        fig.savefig(output_folder / f'AnomalyMap_{name}.png', dpi = 300, facecolor = 'w')
+        plt.close(fig)
+        return output_folder
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Ranks every country and continent by the anomaly of the fire activity of the specific period of a config with respect to its reference period')
+    parser.add_argument('config', help = 'configuration file (variable, aggregating_operation, specific and reference dates, output_folder, backend)')
+    parser.add_argument('--mode', default = 'period', choices = ['period', 'daily'])
+    parser.add_argument('--regions', default = 'all', choices = ['all', 'countries', 'continents'])
+    parser.add_argument('--top', default = 20, type = int, help = 'number of regions printed')
+    args = parser.parse_args()
+    matplotlib.use('Agg')
+    config = config_file(args.config).TOTAL_CONFIG
+    ranking = AnomalyRanking(config, mode = args.mode, regions = args.regions)
+    table = ranking.compute()
+    print(table.head(args.top).to_string())
+    print(f'Results saved in {ranking.save()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+from shapely import wkb
+from shapely.geometry import box
+
+######local imports
+from emission_explorer.GfasActivityReader import QueryCancelled
+from emission_explorer.PartialAggregates import PARTIAL_OPERATIONS, MERGEABLE_OPERATIONS, to_partial, merge_partials, finalize
+
+
+def chunk_tasks(start_date, end_date, polygon, chunk_days = 92, tile_degrees = 10):
+    """Splits an extraction in chunks: time windows of 'chunk_days' days x square tiles of 'tile_degrees' degrees
+    intersecting 'polygon'. Returns a list of (start, end, tile polygon). The tile edges are shifted by a tiny offset so
+    that no grid point falls on them (ST_Contains does not count the points on the boundary)."""
+    windows = []
+    window_start = pd.Timestamp(start_date)
+    while window_start <= pd.Timestamp(end_date):
+        window_end = min(window_start + pd.Timedelta(days = chunk_days - 1), pd.Timestamp(end_date))
+        windows.append((window_start, window_end))
+        window_start = window_end + pd.Timedelta(days = 1)
+
+    eps = 1e-7
+    minx, miny, maxx, maxy = polygon.bounds
+    tiles = []
+    for x0 in np.arange(np.floor(minx/tile_degrees)*tile_degrees, maxx, tile_degrees):
+        for y0 in np.arange(np.floor(miny/tile_degrees)*tile_degrees, maxy, tile_degrees):
+            tile = polygon.intersection(box(x0 - eps, y0 - eps, x0 + tile_degrees - eps, y0 + tile_degrees - eps))
+            if not tile.is_empty and tile.area > 0:
+                tiles.append(tile)
+    return [(window_start, window_end, tile) for window_start, window_end in windows for tile in tiles]
+
+
+def run_chunk(reader_factory, table_name, start_date, end_date, tile_wkb, resolution, keep_separate_dates, lean):
+    """Worker of 'extract_data_polygon_chunked': partial aggregates (see PartialAggregates) of the cells of one chunk
+    and the first and last date found. The raw points are dropped in the worker."""
+    reader = reader_factory()
+    data_or, data = reader.extract_data_polygon(table_name, start_date, end_date, wkb.loads(tile_wkb),
+                                                agg_operations = list(PARTIAL_OPERATIONS), resolution = resolution,
+                                                keep_separate_dates = keep_separate_dates, lean = lean)
+    if data is None or data.empty:
+        return None, None, None
+    return to_partial(data), data_or.index.min(), data_or.index.max()
+
+
+def terminate_workers(executor):
+    """Stops the worker processes of 'executor' at once, the running chunks included"""
+    processes = list((executor._processes or {}).values()) # no public API before python 3.14
+    executor.shutdown(wait = False, cancel_futures = True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def extract_data_polygon_chunked(reader_factory, table_name, start_date, end_date, polygon, agg_operations = None,
+                                 resolution = 0.1, keep_separate_dates = True, lean = False,
+                                 chunk_days = 92, tile_degrees = 10, max_workers = None, is_cancelled = None):
+    """Out-of-core version of 'extract_data_polygon' for large regions and periods (e.g. global, whole archive). The
+    extraction is split by time windows and spatial tiles (see 'chunk_tasks'), every chunk is aggregated in cells by a
+    worker process with its own reader ('reader_factory()', must be picklable, e.g. functools.partial(create_reader,
+    config)) and the partial aggregates (count, sum, min, max, M2) are merged as soon as they are ready. At most
+    2*'max_workers' chunks are in flight, so the memory is bounded by the size of a chunk and of the merged cells.
+    The workers are spawned, not forked: they must not inherit the pooled database connections of the parent
+    (GfasActivityReader engines) nor its DuckDB connections (parquet readers).
+    'is_cancelled' (callable) is checked while the chunks run: when it returns True the workers are terminated and
+    QueryCancelled is raised. The workers are terminated as well when a chunk fails (e.g. TimeoutError of the readers
+    with a latency budget).
+
+    Returns the same outputs of 'extract_data_polygon' in memory-lean mode: a frame with the first and last date found
+    (no raw points) and the aggregated cells. 'median' cannot be computed from partial aggregates."""
+    if agg_operations is None:
+        agg_operations = ['sum']
+    if isinstance(agg_operations, str):
+        agg_operations = [agg_operations]
+    unsupported = [op for op in agg_operations if op not in MERGEABLE_OPERATIONS]
+    if unsupported:
+        raise ValueError(f"The operations {unsupported} are not available in the chunked mode, use any of {MERGEABLE_OPERATIONS}")
+    if max_workers is None:
+        max_workers = os.cpu_count()
+
+    tasks = chunk_tasks(start_date, end_date, polygon, chunk_days = chunk_days, tile_degrees = tile_degrees)
+    print(f'CHUNKED: {len(tasks)} chunks on {max_workers} workers')
+    result = dict(partial = pd.DataFrame(), first = None, last = None)
+
+    def merge_done(done):
+        for future in done:
+            chunk_partial, chunk_first, chunk_last = future.result()
+            if chunk_partial is None:
+                continue
+            result['partial'] = merge_partials(result['partial'], chunk_partial)
+            result['first'] = chunk_first if result['first'] is None else min(result['first'], chunk_first)
+            result['last'] = chunk_last if result['last'] is None else max(result['last'], chunk_last)
+
+    def wait_first(pending):
+        while True:
+            done, pending = wait(pending, timeout = 0.5, return_when = FIRST_COMPLETED)
+            if (is_cancelled is not None) and is_cancelled():
+                raise QueryCancelled('The query was cancelled.')
+            if done:
+                return done, pending
+
+    with ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+        try:
+            pending = set()
+            for chunk_start, chunk_end, tile in tasks:
+                if len(pending) >= 2*max_workers: # merge the finished chunks before submitting new ones (bounded memory)
+                    done, pending = wait_first(pending)
+                    merge_done(done)
+                pending.add(executor.submit(run_chunk, reader_factory, table_name, chunk_start, chunk_end, tile.wkb,
+                                            resolution, keep_separate_dates, lean))
+            while pending:
+                done, pending = wait_first(pending)
+                merge_done(done)
+        except BaseException:
+            terminate_workers(executor)
+            raise
+
+    partial, first, last = result['partial'], result['first'], result['last']
+    if partial.empty:
+        return partial, partial
+    data_span = pd.DataFrame(index = pd.DatetimeIndex([first, last], name = 'datetime'))
+    final = [finalize(partial, op) for op in agg_operations]
+    data = final[0]
+    for other in final[1:]:
+        data = data.join(other.drop(columns = 'geometry'))
+    # same column order of the readers: variables, then operations
+    names = [col[:-len('_count')] for col in partial.columns if col.endswith('_count')]
+    data = data[[f'{name}_{op}' for name in names for op in agg_operations] + ['geometry']]
+    return data_span, data.sort_index()
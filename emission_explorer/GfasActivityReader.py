@@ -1,34 +1,144 @@
 from datetime import datetime
+import copy
+import os
+import sys
+import threading
+import time
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import box
 import matplotlib.pyplot as plt
 import psycopg2
+import psycopg2.extras
+from psycopg2.extensions import QueryCanceledError
 from shapely import wkt
 from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
 # ST_MakePolygon(ST_GeomFromText('LINESTRING(-88.4646835327148 40.2789344787598 231.220825195312, -88.4761428833008 40.2101783752441 223.626693725586,-88.4646835327148 40.2159080505371 235.470901489258,-88.4646835327148 40.2789344787598 231.220825195312,-88.4646835327148 40.2789344787598 231.220825195312)')), 4326)
 
 
-class GfasActivityReader(object):
+def frame_memory_mb(data):
+    """Memory used by a DataFrame (deep, i.e. including the python objects) in MB"""
+    if data is None:
+        return 0
+    return data.memory_usage(deep = True).sum()/1024**2
 
-    conn = None
-    cur = None
 
-    def __init__(self):
-        
-        try:
-            connection_string = "dbname='wfdb' user='wfuser' host='localhost'"
-            # self.conn = psycopg2.connect(connection_string)
-            engine = create_engine('postgresql+psycopg2://wfuser@localhost/wfdb')
-            self.conn = engine
-        except:
-            print("I am unable to connect to the database")
-            
-        if self.conn is None:
-            raise ConnectionError("It was not possible to connect to the PostGIS database, please contact the administration to review permissions.")
-        # self.cur = self.conn.cursor()
-		
+def current_rss_mb():
+    """Current resident memory of the process in MB (psutil, or /proc on Linux; None if not available)"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss/1024**2
+    try:
+        with open('/proc/self/statm') as src:
+            return int(src.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1024**2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    """Peak resident memory of the current process since it started in MB (None if not available)"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss/1024**2 if sys.platform == 'darwin' else maxrss/1024
+
+
+def downcast_values(data, rtol = 1e-6):
+    """Converts the float64 columns of 'data' to float32 when every value is recovered within 'rtol' (i.e. no overflow
+    or loss of precision for very small values)"""
+    for col in data.columns:
+        if data[col].dtype == np.float64:
+            values = data[col].values
+            values32 = values.astype(np.float32)
+            if np.allclose(values32.astype(np.float64), values, rtol = rtol, atol = 0, equal_nan = True):
+                data[col] = values32
+    return data
+
+
+DEFAULT_CONNECTION_URL = 'postgresql+psycopg2://wfuser@localhost/wfdb'
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(connection_url):
+    """Returns the SQLAlchemy engine of 'connection_url'. The engine (and its connection pool) is created only once per
+    process and shared by every reader, so that the connections stay open between queries."""
+    with _engines_lock:
+        if connection_url not in _engines:
+            _engines[connection_url] = create_engine(connection_url, pool_pre_ping = True)
+        return _engines[connection_url]
+
+
+class QueryCancelled(RuntimeError):
+    """Raised by the queries cancelled by the user (see 'GfasActivityReader.cancel' and 'interruptible_queries')"""
+
+
+def interruptible_queries():
+    """Makes the database queries of the process interruptible with Ctrl-C (CLI): psycopg2 waits for the results with
+    'wait_select', which sends a cancel request to the server on KeyboardInterrupt, so the query is stopped on the
+    server too and raises 'QueryCancelled'."""
+    psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
+
+
+def sample_relative_error(estimate, standard_error):
+    """Relative standard error of the total (or of the average) of independent estimates, e.g. the days of a preview"""
+    if len(estimate) == 0:
+        return np.nan
+    total = np.abs(np.nansum(np.asarray(estimate, dtype = np.float64)))
+    if total == 0:
+        return np.nan
+    return np.sqrt(np.nansum(np.asarray(standard_error, dtype = np.float64)**2)) / total
+
+
+class GfasReaderBase(object):
+    """Interface of the readers of the GFAS data. Every backend (PostGIS database: GfasActivityReader, local cubes:
+    GfasCubeReader, Parquet files: GfasParquetReader) implements 'extract_data2' and 'extract_data_polygon' with the same
+    arguments and outputs; the aggregation of the points in cells is shared."""
+
+    def extract_data2(self, start_date, end_date, polygon, table_name, agg_operation = None):
+        """Extract aggregation operator (like 'sum' or 'mean') of all values for every single day for the region selected,
+        return one value per day (one column per variable if 'table_name' is a list of tables)"""
+        raise NotImplementedError
+
+    def extract_data_polygon(self, table_name, start_date, end_date, polygon, agg_operations = None, resolution = 0.1, keep_separate_dates = True, aggregate = True, lean = False):
+        """Extract every point contained in 'polygon' between 'start_date' and 'end_date' and aggregate them in square
+        cells of 'resolution' degrees. Returns the points and the aggregated data."""
+        raise NotImplementedError
+
+    def extract_data_regions(self, start_date, end_date, regions, table_name, agg_operation = None):
+        """Same as 'extract_data2' for many regions at once ('regions': dictionary name -> polygon): one value per day
+        and region, returned as one column per region (regions without data are all NaN)"""
+        columns = {}
+        for name, polygon in regions.items():
+            data = self.extract_data2(start_date, end_date, polygon, table_name, agg_operation)
+            columns[name] = data.iloc[:, 0]
+        data = pd.DataFrame(columns, columns = list(regions))
+        data.index.name = 'datetime'
+        return data.sort_index()
+
+    @staticmethod
+    def mask_empty_groups(data_aggr, grouped):
+        """With more variables (one column each) a point can have data for only some of them: the aggregates of a
+        variable without any value in a cell would be 0 ('sum', 'count') instead of missing, so they are set to NaN
+        (see 'data_handler.query_data.split_by_variable', which drops them)"""
+        variables = data_aggr.columns.get_level_values(0).unique()
+        if len(variables) < 2:
+            return data_aggr
+        counts = grouped[list(variables)].count()
+        for col in data_aggr.columns:
+            data_aggr[col] = data_aggr[col].where(counts[col[0]].values > 0)
+        return data_aggr
+
     def aggregate_by_cluster(self, data=None, res = 0.1, functions = None, columns_to_group = None):
         """Transform a GeoDataFrame of points geometry into square of resolution of 'res' degrees". All points contained in the grid
         of 'res' degrees are aggregated together"""   
@@ -42,7 +152,8 @@ class GfasActivityReader(object):
                                                        (np.floor(data.geometry.y*factor))/factor)]
         if 'clust' not in columns_to_group:
             columns_to_group.append('clust')
-        data_aggr = data[[col for col in data.columns if 'geom' not in col]].groupby(columns_to_group).agg(functions)
+        grouped = data[[col for col in data.columns if 'geom' not in col]].groupby(columns_to_group)
+        data_aggr = self.mask_empty_groups(grouped.agg(functions), grouped)
 
         # just to check if the index is a multiindex
         if isinstance(data_aggr.index.values[0],tuple):
@@ -65,11 +176,266 @@ class GfasActivityReader(object):
         
         return data_aggr
 
+    def aggregate_by_cell_id(self, data = None, res = 0.1, functions = None, columns_to_group = None):
+        """Same as 'aggregate_by_cluster' for a DataFrame with 'lon' and 'lat' columns (no point geometries): the cell of 
+        every point is stored as an integer id instead of a 'x_y' string and the square geometries are only built once
+        per cell. The returned 'clust' level contains the integer ids."""
+        factor = 1/res
+        offset = int(round(180*factor))
+        ny = 2*offset + 1
+        ix = np.floor(data['lon'].values*factor).astype(np.int64)
+        iy = np.floor(data['lat'].values*factor).astype(np.int64)
+        data['clust'] = ((ix + offset)*ny + (iy + offset)).astype(np.int32)
+        if 'clust' not in columns_to_group:
+            columns_to_group.append('clust')
+        grouped = data[[col for col in data.columns if col not in ['lon', 'lat']]].groupby(columns_to_group)
+        data_aggr = self.mask_empty_groups(grouped.agg(functions), grouped)
+
+        # add geometry column (one box per cell, shared by all the dates)
+        clust = data_aggr.index.get_level_values('clust')
+        cells = np.unique(clust.values)
+        boxes = {cell: box((cell//ny - offset)/factor, (cell%ny - offset)/factor,
+                           (cell//ny - offset)/factor + res, (cell%ny - offset)/factor + res) for cell in cells}
+        geom = pd.Series([boxes[cell] for cell in clust.values], index = data_aggr.index)
+        data_aggr = gpd.GeoDataFrame(data_aggr, geometry = geom, crs = 'EPSG:4326')
+
+        #rename columns (transform multicolumns in columns)
+        new_cols = ['_'.join(tt) for tt in data_aggr.columns]
+        new_cols = [f[:-1] if f[-1]=='_' else f for f in new_cols]
+        data_aggr.columns = new_cols
+        return data_aggr
+
+    def aggregate_points(self, data, agg_operations, resolution = 0.1, keep_separate_dates = True, aggregate = True, lean = False):
+        """Second part of 'extract_data_polygon': aggregates in cells the points (WKT 'geom' column, or 'lon' and 'lat'
+        columns) of every day. Returns the points and the aggregated data."""
+        if lean:
+            return self.aggregate_lean(data, agg_operations, resolution, keep_separate_dates, aggregate)
+        
+        if 'geom' in data.columns:
+            data['geom'] = data.geom.apply(wkt.loads)
+        else:
+            data['geom'] = gpd.points_from_xy(data.pop('lon'), data.pop('lat'))
+        data = gpd.GeoDataFrame(data, geometry = data['geom'])
+        if data.empty:
+            return data, data
+        # AGGREGATE BY CLUSTER
+        if keep_separate_dates:
+            cols_to_group = ['datetime','clust']
+        else:
+            cols_to_group = ['clust']
+            
+        if aggregate:
+            data_aggregated = self.aggregate_by_cluster(data = data, res = resolution, 
+                                                        functions = agg_operations, #['sum','mean','std','max','min','count'],
+                                                        columns_to_group = cols_to_group)
+        else:
+            data_aggregated = None
+            
+        return data, data_aggregated
+
+    def aggregate_lean(self, data, agg_operations, resolution = 0.1, keep_separate_dates = True, aggregate = True):
+        """Memory-lean version of the aggregation of 'extract_data_polygon' for a DataFrame of lon/lat points"""
+        if [stage for stage, _, _, _ in getattr(self, 'memory_report', [])] != ['start']:
+            self.start_memory_report() # no measure before the query
+        self.memory_report.append(('query', frame_memory_mb(data), current_rss_mb(), peak_rss_mb()))
+        data = downcast_values(data)
+        self.memory_report.append(('downcast', frame_memory_mb(data), current_rss_mb(), peak_rss_mb()))
+        if data.empty:
+            data = gpd.GeoDataFrame(data, geometry = gpd.points_from_xy(data.lon, data.lat), crs = 'EPSG:4326')
+            return data, data
+        # only the first and last dates of the raw points are kept
+        data_span = data.iloc[[0, -1]][[]]
+        if not aggregate:
+            return data_span, None
+        if keep_separate_dates:
+            cols_to_group = ['datetime','clust']
+        else:
+            cols_to_group = ['clust']
+        data_aggregated = self.aggregate_by_cell_id(data = data, res = resolution,
+                                                    functions = agg_operations, columns_to_group = cols_to_group)
+        del data
+        data_aggregated = downcast_values(data_aggregated)
+        self.memory_report.append(('aggregate', frame_memory_mb(data_aggregated), current_rss_mb(), peak_rss_mb()))
+        return data_span, data_aggregated
+
+    def start_memory_report(self):
+        """Measures the memory before an extraction of the lean mode, the report of 'aggregate_lean' is relative to it"""
+        self.memory_report = [('start', 0, current_rss_mb(), peak_rss_mb())]
+
+    def print_memory_report(self):
+        """Prints, per stage, the frame size and the resident memory with its change since the previous stage. The
+        peak is the one of the whole process (it only grows, e.g. with the previous extractions)."""
+        previous = None
+        for stage, frame_mb, rss_mb, peak_mb in getattr(self, 'memory_report', []):
+            rss = f'{rss_mb:.1f} MB' if rss_mb is not None else 'n/a'
+            if (rss_mb is not None) and (previous is not None):
+                rss += f' ({rss_mb - previous:+.1f} MB)'
+            peak = f'{peak_mb:.1f} MB' if peak_mb is not None else 'n/a'
+            print(f'MEMORY {stage:>10}: frame {frame_mb:.1f} MB, RSS {rss}, process peak RSS {peak}')
+            previous = rss_mb
+
+
+class GfasActivityReader(GfasReaderBase):
+
+    conn = None
+    cur = None
+    diagnostics = None # QueryDiagnostics: the plan of every query is captured (see 'diagnostics' in the config)
+    statement_timeout = None # seconds: longer queries are stopped by the server and raise TimeoutError (see 'with_limits')
+    budget_end = None # time.monotonic() of the end of the latency budget shared by all the queries (see 'with_limits')
+    sample_percent = None # percent of the disk blocks read (SYSTEM sample) by the approximate previews (see 'with_limits')
+
+    def __init__(self, connection_url = None):
+        """Reader of the GFAS tables of the PostGIS database. The database is 'connection_url' if given, otherwise
+        the 'WFDB_URL' environment variable (e.g. to point to a local stand-in database) or the default ECMWF one."""
+        if connection_url is None:
+            connection_url = os.environ.get('WFDB_URL', DEFAULT_CONNECTION_URL)
+        try:
+            connection_string = "dbname='wfdb' user='wfuser' host='localhost'"
+            # self.conn = psycopg2.connect(connection_string)
+            engine = get_engine(connection_url)
+            self.conn = engine
+        except:
+            print("I am unable to connect to the database")
+            
+        if self.conn is None:
+            raise ConnectionError("It was not possible to connect to the PostGIS database, please contact the administration to review permissions.")
+        # self.cur = self.conn.cursor()
+        self.running = [] # DBAPI connections of the queries running (see 'cancel')
+        self.cancelled = False
+
+    def with_limits(self, statement_timeout = None, sample_percent = None, budget_end = None):
+        """Copy of the reader (same engine) whose queries are stopped by the server after 'statement_timeout' seconds,
+        or when the latency budget ending at 'budget_end' (time.monotonic()) is over (TimeoutError), and/or read a
+        sample of 'sample_percent' % of the disk blocks of every table: the results are then approximate, scaled to the
+        whole data and marked with their error in 'data.attrs['preview']' (see 'sampled_estimates')."""
+        reader = copy.copy(self)
+        reader.statement_timeout = statement_timeout
+        reader.sample_percent = sample_percent
+        reader.budget_end = budget_end
+        reader.running = []
+        reader.cancelled = False
+        return reader
+
+    def cancel(self):
+        """Cancels the running (and following) queries of the reader, e.g. from the GUI or the query service thread:
+        the server stops them and they raise 'QueryCancelled'"""
+        self.cancelled = True
+        for dbapi_connection in list(self.running):
+            dbapi_connection.cancel()
+
+    def table_from(self, table_name):
+        """FROM item of a table: a repeatable sample of its disk blocks when 'sample_percent' is set. SYSTEM sampling
+        only reads the sampled blocks (BERNOULLI would still read the whole table), so the block is the sampling unit of
+        the error estimates."""
+        if self.sample_percent is None:
+            return table_name
+        return f'{table_name} TABLESAMPLE SYSTEM ({float(self.sample_percent)}) REPEATABLE (0)'
+
+    def iterate_months(self, table_name, start_date, end_date):
+        """Yields (month_start, points) for every month between 'start_date' and 'end_date': all the points of the table
+        'table_name' (DataFrame with 'datetime', 'lon', 'lat' and 'value' columns), e.g. to copy the table into a local
+        backend (see 'GfasCubeReader.build_from_reader' and 'GfasParquetReader.export_from_reader')."""
+        for month_start in pd.date_range(pd.Timestamp(start_date).replace(day = 1), end_date, freq = 'MS'):
+            month_end = min(month_start + pd.offsets.MonthEnd(1), pd.Timestamp(end_date))
+            query = f"""SELECT datetime, ST_X(geom) AS lon, ST_Y(geom) AS lat, value FROM {table_name}
+                    WHERE datetime >= %(start_date)s AND datetime <= %(end_date)s;"""
+            data = self.query(query, {'start_date': month_start, 'end_date': month_end}).reset_index()
+            print(f'{table_name} {month_start:%Y-%m}: {len(data)} points')
+            yield month_start, data
+
+    def sample_daily_select(self, table_name, agg_operation):
+        """SELECT of the daily aggregates of the block sample of a table in the 'region' CTE (see 'sampled_estimates').
+        For 'SUM' and 'AVG' the values are first summed by sampled block and day (columns 'y', 'n', 'yy', 'yn', 'nn'),
+        the other operations are computed on the sampled points (column 'value')."""
+        variable = table_name.replace('_data','')
+        where = f"""datetime >= %(start_date)s AND datetime <= %(end_date)s AND
+                    ST_Contains(region.polygon, geom)"""
+        if agg_operation in ['SUM', 'AVG']:
+            return f"""SELECT datetime, '{variable}' AS variable, SUM(y) AS y, SUM(n) AS n, SUM(y*y) AS yy, SUM(y*n) AS yn, SUM(n*n) AS nn
+                FROM (SELECT datetime, ({table_name}.ctid::text::point)[0] AS block, SUM(value) AS y, COUNT(value) AS n
+                    FROM {self.table_from(table_name)}, region
+                    WHERE {where}
+                    GROUP BY datetime, block) AS blocks
+                GROUP BY datetime"""
+        return f"""SELECT datetime, '{variable}' AS variable, {agg_operation}(value) AS value
+                FROM {self.table_from(table_name)}, region
+                WHERE {where}
+                GROUP BY datetime"""
+
+    def sampled_estimates(self, data, agg_operation):
+        """Estimates of the whole data from the aggregates of a block sample (see 'sample_daily_select'). Every block is
+        in the sample with probability pi = sample_percent/100, y_b and n_b are the sum and the number of the values of
+        a sampled block:
+         - 'SUM': Horvitz-Thompson estimate sum(y_b)/pi, variance (1 - pi)/pi**2 * sum(y_b**2).
+         - 'AVG': ratio estimate R = sum(y_b)/sum(n_b), variance (1 - pi) * sum((y_b - R*n_b)**2) / sum(n_b)**2.
+         - other operations: the sample values, without standard error ('MIN' and 'MAX' are bounds of the true values).
+        Returns the estimates and their standard errors."""
+        pi = self.sample_percent/100
+        if agg_operation == 'SUM':
+            return data['y']/pi, np.sqrt((1 - pi)*data['yy'])/pi
+        if agg_operation == 'AVG':
+            ratio = data['y']/data['n']
+            residuals = (data['yy'] - 2*ratio*data['yn'] + ratio**2*data['nn']).clip(lower = 0)
+            return ratio, np.sqrt((1 - pi)*residuals)/data['n']
+        return data['value'], pd.Series(np.nan, index = data.index)
+
+    def sample_total_error(self, start_date, end_date, polygon, table_names):
+        """Relative standard error of the total of the values in 'polygon' estimated from the block sample (largest of
+        the tables), computed from the totals of the sampled blocks. It is the error of the preview maps as a whole:
+        the cells, with few points each, have larger errors."""
+        selects = [f"""SELECT MIN(datetime) AS datetime, '{tab.replace('_data','')}' AS variable, SUM(y) AS y, SUM(y*y) AS yy
+                FROM (SELECT MIN(datetime) AS datetime, SUM(value) AS y
+                    FROM {self.table_from(tab)}, region
+                    WHERE datetime >= %(start_date)s AND datetime <= %(end_date)s AND
+                    ST_Contains(region.polygon, geom)
+                    GROUP BY ({tab}.ctid::text::point)[0]) AS blocks""" for tab in table_names]
+        union = '\n                UNION ALL\n                '.join(selects)
+        query = f"""WITH region AS (SELECT ST_GeomFromText('{polygon.wkt}', 4326) AS polygon)
+                {union};"""
+        totals = self.query(query, {'start_date': start_date, 'end_date': end_date})
+        pi = self.sample_percent/100
+        relative_errors = np.sqrt((1 - pi)*totals['yy'].astype(np.float64)) / totals['y'].astype(np.float64).abs()
+        return max([float(err) for err in relative_errors if np.isfinite(err)], default = np.nan)
+
+    def set_timeout(self, connection):
+        """Sets the statement timeout of the next statements of the transaction of 'connection': 'statement_timeout' or
+        the rest of the latency budget (TimeoutError if it is over). Returns it in seconds (None if not limited)."""
+        timeout = self.statement_timeout
+        if self.budget_end is not None:
+            remaining = self.budget_end - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('The latency budget is over.')
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if timeout is not None: # only for the transaction of this query
+            connection.exec_driver_sql(f'SET LOCAL statement_timeout = {max(int(timeout*1000), 1)}')
+        return timeout
+
     def query(self, query, params):
 
 #         self.cur.execute(query, params)
-        df = pd.read_sql_query(query, self.conn,
-                            params = params)
+        if self.cancelled:
+            raise QueryCancelled('The query was cancelled.')
+        with self.conn.connect() as connection:
+            dbapi_connection = connection.connection.dbapi_connection
+            self.running.append(dbapi_connection)
+            timeout, started = None, time.monotonic()
+            try:
+                # the EXPLAIN ANALYZE of the diagnostics runs the query too: same limits, cancellable
+                if self.diagnostics is not None:
+                    timeout, started = self.set_timeout(connection), time.monotonic()
+                    self.diagnostics.explain(self.conn, query, params, connection = connection)
+                timeout, started = self.set_timeout(connection), time.monotonic()
+                df = pd.read_sql_query(query, connection,
+                                    params = params)
+            except OperationalError as err:
+                if not isinstance(err.orig, QueryCanceledError):
+                    raise
+                # the server reports the cancels and the timeouts with the same SQLSTATE (57014)
+                if self.cancelled or (timeout is None) or (time.monotonic() - started < 0.9*timeout):
+                    raise QueryCancelled('The query was cancelled.') from err
+                raise TimeoutError(f'The query took more than the statement timeout ({timeout:.1f} s).') from err
+            finally:
+                self.running.remove(dbapi_connection)
         df = df.set_index(['datetime'])
         return df
 
@@ -93,7 +459,8 @@ class GfasActivityReader(object):
     
     def extract_data2(self, start_date, end_date, polygon, table_name, agg_operation = None):
         """Extract aggregation operator (like 'sum' or 'mean') of all values for every single day for the region selected,
-        return one value per day"""
+        return one value per day. If 'table_name' is a list of tables all the variables are extracted in a single query
+        and returned as one column per variable."""
         sql_conversion = {'mean':'AVG','median':'median','std':'stddev','min':'MIN','max':'MAX','sum':'SUM'}
         
         if agg_operation is None:
@@ -101,6 +468,15 @@ class GfasActivityReader(object):
         else:
             agg_operation = sql_conversion[agg_operation]
 
+        if self.sample_percent is not None:
+            if not isinstance(table_name, str):
+                return self.extract_data2_sampled(start_date, end_date, polygon, table_name, agg_operation)
+            data = self.extract_data2_sampled(start_date, end_date, polygon, [table_name], agg_operation)
+            data.columns = data.attrs['preview']['standard_error'].columns = [agg_operation.lower()] # as the exact query
+            return data
+        if not isinstance(table_name, str):
+            return self.extract_data2_multi(start_date, end_date, polygon, table_name, agg_operation)
+
         query = f"""SELECT datetime, {agg_operation}(value) FROM {table_name}
                 WHERE datetime >= %(start_date)s AND datetime <= %(end_date)s AND
                 ST_Contains(ST_GeomFromText('{polygon.wkt}', 4326), geom)
@@ -116,42 +492,135 @@ class GfasActivityReader(object):
 #         print(data.sum().iloc[0])
         return data
     
-    def extract_data_polygon(self, table_name, start_date, end_date, polygon, agg_operations = None, resolution = 0.1, keep_separate_dates = True, aggregate = True):
+    def extract_data2_multi(self, start_date, end_date, polygon, table_names, agg_operation = 'SUM'):
+        """Same as 'extract_data2' for several variables at once: the region filter is written once in a CTE and
+        shared by all the tables, the daily aggregates are stacked with UNION ALL and pivoted into one column per
+        variable (named as the table without '_data')."""
+        selects = [f"""SELECT datetime, '{tab.replace('_data','')}' AS variable, {agg_operation}(value) AS value
+                FROM {tab}, region
+                WHERE datetime >= %(start_date)s AND datetime <= %(end_date)s AND
+                ST_Contains(region.polygon, geom)
+                GROUP BY datetime""" for tab in table_names]
+        union = '\n                UNION ALL\n                '.join(selects)
+        query = f"""WITH region AS (SELECT ST_GeomFromText('{polygon.wkt}', 4326) AS polygon)
+                {union}
+                ORDER BY datetime;"""
+        params = {
+            'start_date': start_date,
+            'end_date': end_date
+        }
+
+        data = self.query(query, params)
+        data = data.pivot(columns = 'variable', values = 'value')
+        data.columns.name = None
+        # keep the order of the variables as requested
+        return data[[tab.replace('_data','') for tab in table_names if tab.replace('_data','') in data.columns]]
+
+    def extract_data2_sampled(self, start_date, end_date, polygon, table_names, agg_operation = 'SUM'):
+        """Preview version of 'extract_data2_multi' on the block sample of every table (see 'sample_daily_select' and
+        'sampled_estimates'). Returns one column per variable and, in 'data.attrs['preview']', the sample, the daily
+        standard errors and the relative error of the total of the period (the largest of the variables)."""
+        union = '\n                UNION ALL\n                '.join([self.sample_daily_select(tab, agg_operation) for tab in table_names])
+        query = f"""WITH region AS (SELECT ST_GeomFromText('{polygon.wkt}', 4326) AS polygon)
+                {union}
+                ORDER BY datetime;"""
+        params = {
+            'start_date': start_date,
+            'end_date': end_date
+        }
+        data = self.query(query, params)
+        estimate, standard_error = self.sampled_estimates(data, agg_operation)
+        data = data.assign(value = estimate, standard_error = standard_error)
+        var_names = [tab.replace('_data','') for tab in table_names]
+        values = data.pivot(columns = 'variable', values = 'value').reindex(columns = var_names)
+        standard_error = data.pivot(columns = 'variable', values = 'standard_error').reindex(columns = var_names)
+        values.columns.name = standard_error.columns.name = None
+        relative_errors = [sample_relative_error(values[var].dropna(), standard_error[var].dropna()) for var in var_names]
+        values.attrs['preview'] = dict(sample_percent = self.sample_percent, standard_error = standard_error,
+                                       relative_error = max([err for err in relative_errors if not np.isnan(err)], default = np.nan))
+        return values
+
+    def extract_data_regions(self, start_date, end_date, regions, table_name, agg_operation = None):
+        """Same as 'extract_data2' for many regions at once ('regions': dictionary name -> polygon) in a single query:
+        the regions are joined to the points (a point can belong to more regions, e.g. a country and its continent) and
+        the values are grouped by day and region. Returns one column per region (regions without data are all NaN)."""
+        sql_conversion = {'mean':'AVG','median':'median','std':'stddev','min':'MIN','max':'MAX','sum':'SUM'}
+        agg_operation = 'SUM' if agg_operation is None else sql_conversion[agg_operation]
+        names = list(regions)
+        # the regions are identified by their position (the names can contain quotes)
+        values = ',\n                    '.join([f"({i}, ST_GeomFromText('{polygon.wkt}', 4326))" for i, polygon in enumerate(regions.values())])
+        query = f"""WITH regions (region, polygon) AS (VALUES
+                    {values})
+                SELECT datetime, region, {agg_operation}(value) AS value FROM {table_name}
+                JOIN regions ON ST_Contains(regions.polygon, geom)
+                WHERE datetime >= %(start_date)s AND datetime <= %(end_date)s
+                GROUP BY datetime, region
+                ORDER BY datetime;"""
+        params = {
+            'start_date': start_date,
+            'end_date': end_date
+        }
+        data = self.query(query, params)
+        data = data.pivot(columns = 'region', values = 'value')
+        data = data.reindex(columns = range(len(names)))
+        data.columns = names
+        return data
+
+    def extract_data_polygon(self, table_name, start_date, end_date, polygon, agg_operations = None, resolution = 0.1, keep_separate_dates = True, aggregate = True, lean = False):
+        """Extract every point contained in 'polygon' between 'start_date' and 'end_date' and aggregate them in square
+        cells of 'resolution' degrees. If 'table_name' is a list of tables all the variables are read in a single query
+        and the returned frames have one column per variable (joined on datetime and geom).
+        With 'lean' the memory-lean mode is used: points are read as lon/lat floats (no WKT geometries), values are
+        downcast to float32 when precision allows, cells get integer ids and the raw points are not kept (the first
+        returned frame only contains the first and last date). The memory used per stage is stored in 'self.memory_report'."""
         if agg_operations is None:
             agg_operations = ['sum'] #['sum','mean','std','max','min','count']
         if isinstance(agg_operations, str):
             agg_operations = [agg_operations]
-        var_name = table_name.replace('_data','')
+        if lean:
+            geom_select = 'ST_X(geom) AS lon, ST_Y(geom) AS lat'
+        else:
+            geom_select = 'ST_AsText(geom) AS geom'
         
-        query_pandas = f"""SELECT datetime, ST_AsText(geom) AS geom, value as {var_name} FROM {table_name}
-                WHERE datetime >= %(start_date)s AND datetime <= %(end_date)s AND
-                ST_Contains(ST_GeomFromText('{polygon.wkt}', 4326), geom)
-                ORDER BY datetime;"""
+        if isinstance(table_name, str):
+            var_name = table_name.replace('_data','')
+            query_pandas = f"""SELECT datetime, {geom_select}, value as {var_name} FROM {self.table_from(table_name)}
+                    WHERE datetime >= %(start_date)s AND datetime <= %(end_date)s AND
+                    ST_Contains(ST_GeomFromText('{polygon.wkt}', 4326), geom)
+                    ORDER BY datetime;"""
+        else:
+            var_names = [tab.replace('_data','') for tab in table_name]
+            selects = [f"""SELECT datetime, geom, '{var}' AS variable, value FROM {self.table_from(tab)}, region
+                    WHERE datetime >= %(start_date)s AND datetime <= %(end_date)s AND
+                    ST_Contains(region.polygon, geom)""" for var, tab in zip(var_names, table_name)]
+            union = '\n                    UNION ALL\n                    '.join(selects)
+            # wide view keyed on (datetime, geom): one column per variable
+            columns = ', '.join([f"MAX(value) FILTER (WHERE variable = '{var}') AS {var}" for var in var_names])
+            query_pandas = f"""WITH region AS (SELECT ST_GeomFromText('{polygon.wkt}', 4326) AS polygon),
+                    stacked AS (
+                    {union}
+                    )
+                    SELECT datetime, {geom_select}, {columns} FROM stacked
+                    GROUP BY datetime, geom
+                    ORDER BY datetime;"""
         params = {
             'start_date': start_date,
             'end_date': end_date,
         }
         data = self.query(query_pandas, params)
-        
-        data['geom'] = data.geom.apply(wkt.loads)
-        data = gpd.GeoDataFrame(data, geometry = data['geom'])
-        if data.empty:
-            return data, data
-        # AGGREGATE BY CLUSTER
-        if keep_separate_dates:
-            cols_to_group = ['datetime','clust']
-        else:
-            cols_to_group = ['clust']
-            
-        if aggregate:
-            data_aggregated = self.aggregate_by_cluster(data = data, res = resolution, 
-                                                        functions = agg_operations, #['sum','mean','std','max','min','count'],
-                                                        columns_to_group = cols_to_group)
-        else:
-            data_aggregated = None
-            
-        return data, data_aggregated
+        if self.sample_percent is None:
+            return self.aggregate_points(data, agg_operations, resolution, keep_separate_dates, aggregate, lean)
 
+        # preview: the sums and counts of the cells are scaled to the whole data, the error is the one of the total
+        pi = self.sample_percent/100
+        relative_error = self.sample_total_error(start_date, end_date, polygon, [table_name] if isinstance(table_name, str) else table_name)
+        data_or, data_aggregated = self.aggregate_points(data, agg_operations, resolution, keep_separate_dates, aggregate, lean)
+        if data_aggregated is not None:
+            for col in data_aggregated.columns:
+                if col.endswith('_sum') or col.endswith('_count'):
+                    data_aggregated[col] = data_aggregated[col]/pi
+            data_aggregated.attrs['preview'] = dict(sample_percent = self.sample_percent, relative_error = relative_error)
+        return data_or, data_aggregated
 
     #def __del__(self):
     #    self.cur.close()
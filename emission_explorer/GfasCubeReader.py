@@ -0,0 +1,219 @@
+import argparse
+import datetime as dt
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from matplotlib.path import Path as MplPath
+from shapely.geometry import MultiPolygon
+
+######local imports
+from emission_explorer.GfasActivityReader import GfasReaderBase, GfasActivityReader
+
+
+def points_in_polygon(polygon, lon, lat):
+    """Boolean array of the points (lon, lat) contained in 'polygon' (Polygon or MultiPolygon, holes excluded)"""
+    points = np.column_stack([np.asarray(lon, dtype = np.float64), np.asarray(lat, dtype = np.float64)])
+    mask = np.zeros(len(points), dtype = bool)
+    polygons = polygon.geoms if isinstance(polygon, MultiPolygon) else [polygon]
+    for pol in polygons:
+        inside = MplPath(np.asarray(pol.exterior.coords)).contains_points(points)
+        for interior in pol.interiors:
+            inside &= ~MplPath(np.asarray(interior.coords)).contains_points(points)
+        mask |= inside
+    return mask
+
+
+def polygon_mask(polygon, lon, lat):
+    """Boolean array (len(lat), len(lon)) of the grid points (lon, lat) contained in 'polygon' (Polygon or MultiPolygon,
+    holes excluded)"""
+    xx, yy = np.meshgrid(lon, lat)
+    return points_in_polygon(polygon, xx.ravel(), yy.ravel()).reshape(xx.shape)
+
+
+class GfasCubeReader(GfasReaderBase):
+    """Local read backend: every GFAS variable is stored as a daily cube (time x lat x lon) on the fixed 0.1 deg global
+    grid, one memory-mapped float32 file per year ('cube_folder/table_name/YEAR.dat') and its occupancy (uint8, 1 where
+    there is a point, 'YEAR.occ'). Both files are created sparse (never filled), so only the disk pages with fires are
+    written: the cells without points are holes that read as 0 and are returned as NaN. The cubes written by older
+    versions (NaN filled, without occupancy file) are still read.
+
+    A region query slices the days and the bounding box of the polygon directly from the memory map (no copy) and applies
+    a rasterized mask of the polygon (computed once per polygon), so the daily series and the 2D aggregates need no SQL.
+    It has the same 'extract_data2' and 'extract_data_polygon' interface of GfasActivityReader; the points returned are
+    the centers of the grid cells. The cubes are filled from the database with 'build_from_reader'.
+    """
+
+    res = 0.1
+    lat0, lon0 = -90, -180 # south-west corner of the grid
+    nlat = 1800
+    nlon = 3600
+    days_per_chunk = 31 # days read together (bounds the memory of a region query)
+
+    def __init__(self, cube_folder = None):
+        if cube_folder is None:
+            raise ValueError("The 'cube_folder' of the local GFAS cubes is not specified.")
+        self.cube_folder = Path(cube_folder)
+        self.masks = {}
+        self.lat = self.lat0 + (np.arange(self.nlat) + 0.5)*self.res
+        self.lon = self.lon0 + (np.arange(self.nlon) + 0.5)*self.res
+
+    ########## STORAGE
+    def cube_path(self, table_name, year):
+        return self.cube_folder / table_name / f'{year}.dat'
+
+    def occupancy_path(self, table_name, year):
+        return self.cube_folder / table_name / f'{year}.occ'
+
+    def open_year(self, table_name, year, mode = 'r', occupancy = False):
+        """Returns the memory map of the cube (days x lat x lon) of 'year', or of its occupancy with 'occupancy', None if
+        it does not exist (read mode). The new files are sparse: they are not filled, the holes read as 0."""
+        path = self.occupancy_path(table_name, year) if occupancy else self.cube_path(table_name, year)
+        dtype = np.uint8 if occupancy else np.float32
+        ndays = 366 if pd.Timestamp(year = year, month = 12, day = 31).dayofyear == 366 else 365
+        if not path.exists():
+            if (mode == 'r') or (occupancy and self.cube_path(table_name, year).exists()): # older NaN filled cube
+                return None
+            path.parent.mkdir(exist_ok = True, parents = True)
+            return np.memmap(path, dtype = dtype, mode = 'w+', shape = (ndays, self.nlat, self.nlon))
+        return np.memmap(path, dtype = dtype, mode = mode, shape = (ndays, self.nlat, self.nlon))
+
+    def grid_index(self, lon, lat):
+        """Row (lat) and column (lon) of the grid cells containing the points"""
+        rows = np.clip(np.floor((np.asarray(lat) - self.lat0)/self.res + 1e-6).astype(np.int64), 0, self.nlat - 1)
+        cols = np.clip(np.floor((np.asarray(lon) - self.lon0)/self.res + 1e-6).astype(np.int64), 0, self.nlon - 1)
+        return rows, cols
+
+    def add_points(self, table_name, data):
+        """Writes in the cubes the points of 'data' (DataFrame with 'datetime', 'lon', 'lat' and 'value' columns)"""
+        datetimes = pd.DatetimeIndex(data['datetime'])
+        rows, cols = self.grid_index(data['lon'].values, data['lat'].values)
+        for year in np.unique(datetimes.year):
+            sel = datetimes.year == year
+            occupancy = self.open_year(table_name, year, mode = 'r+', occupancy = True)
+            cube = self.open_year(table_name, year, mode = 'r+')
+            cube[datetimes[sel].dayofyear.values - 1, rows[sel], cols[sel]] = data['value'].values[sel]
+            cube.flush()
+            if occupancy is not None:
+                occupancy[datetimes[sel].dayofyear.values - 1, rows[sel], cols[sel]] = 1
+                occupancy.flush()
+            del cube, occupancy
+
+    def build_from_reader(self, reader, table_name, start_date, end_date):
+        """Copies the table 'table_name' from the PostGIS database ('reader' is a GfasActivityReader) into the cubes, one
+        month at a time."""
+        for _, data in reader.iterate_months(table_name, start_date, end_date):
+            self.add_points(table_name, data)
+        with open(self.cube_folder / table_name / 'meta.json', 'w') as dst:
+            json.dump({'table_name': table_name, 'res': self.res, 'updated': f'{dt.datetime.now():%Y-%m-%d %H:%M}'}, dst)
+
+    ########## SELECTION
+    def region(self, polygon):
+        """Rows, columns slices and mask of the bounding box of 'polygon' (cached per polygon)"""
+        hh = hashlib.sha1(polygon.wkb).hexdigest()
+        if hh not in self.masks:
+            minx, miny, maxx, maxy = polygon.bounds
+            r0, c0 = self.grid_index(minx, miny)
+            r1, c1 = self.grid_index(maxx, maxy)
+            rows, cols = slice(int(r0), int(r1) + 1), slice(int(c0), int(c1) + 1)
+            self.masks[hh] = (rows, cols, polygon_mask(polygon, self.lon[cols], self.lat[rows]))
+        return self.masks[hh]
+
+    def iterate_days(self, table_name, start_date, end_date, polygon):
+        """Yields (dates, values, rows, cols) for chunks of days: 'values' (days x cells inside the polygon) and the grid
+        index of the cells"""
+        rows, cols, mask = self.region(polygon)
+        cell_rows, cell_cols = np.nonzero(mask)
+        for year in range(pd.Timestamp(start_date).year, pd.Timestamp(end_date).year + 1):
+            cube = self.open_year(table_name, year)
+            if cube is None:
+                continue
+            occupancy = self.open_year(table_name, year, occupancy = True)
+            first = max(pd.Timestamp(start_date), pd.Timestamp(year = year, month = 1, day = 1))
+            last = min(pd.Timestamp(end_date), pd.Timestamp(year = year, month = 12, day = 31))
+            for d0 in range(first.dayofyear - 1, last.dayofyear, self.days_per_chunk):
+                d1 = min(d0 + self.days_per_chunk, last.dayofyear)
+                window = cube[d0:d1, rows, cols] # view of the memory map, read from disk only when used
+                values = window[:, cell_rows, cell_cols]
+                if occupancy is not None: # no point: NaN
+                    values = np.where(occupancy[d0:d1, rows, cols][:, cell_rows, cell_cols] > 0, values, np.nan)
+                dates = pd.Timestamp(year = year, month = 1, day = 1) + pd.to_timedelta(np.arange(d0, d1), unit = 'D')
+                yield dates, values, cell_rows + rows.start, cell_cols + cols.start
+
+    def extract_data2(self, start_date, end_date, polygon, table_name, agg_operation = None):
+        """Same as GfasActivityReader.extract_data2: one aggregated value per day (days without fires are not returned)"""
+        nan_functions = {'sum': np.nansum, 'mean': np.nanmean, 'median': np.nanmedian, 'std': np.nanstd,
+                         'min': np.nanmin, 'max': np.nanmax}
+        sql_names = {'sum': 'sum', 'mean': 'avg', 'median': 'median', 'std': 'stddev', 'min': 'min', 'max': 'max'}
+        if agg_operation is None:
+            agg_operation = 'sum'
+        tables = [table_name] if isinstance(table_name, str) else list(table_name)
+
+        series = []
+        for tab in tables:
+            all_dates, all_values = [], []
+            for dates, values, _, _ in self.iterate_days(tab, start_date, end_date, polygon):
+                has_data = np.isfinite(values).any(axis = 1)
+                if not has_data.any():
+                    continue
+                if agg_operation == 'std': # same as the SQL stddev (sample standard deviation)
+                    aggregated = nan_functions['std'](values[has_data], axis = 1, ddof = 1)
+                else:
+                    aggregated = nan_functions[agg_operation](values[has_data], axis = 1)
+                all_dates.append(dates[has_data])
+                all_values.append(aggregated.astype(np.float64))
+            name = sql_names[agg_operation] if isinstance(table_name, str) else tab.replace('_data','')
+            if all_dates:
+                series.append(pd.Series(np.concatenate(all_values), index = all_dates[0].append(all_dates[1:]), name = name))
+            else:
+                series.append(pd.Series([], index = pd.DatetimeIndex([]), name = name, dtype = np.float64))
+        data = pd.concat(series, axis = 1)
+        data.index.name = 'datetime'
+        return data.sort_index()
+
+    def extract_data_polygon(self, table_name, start_date, end_date, polygon, agg_operations = None, resolution = 0.1, keep_separate_dates = True, aggregate = True, lean = False):
+        """Same as GfasActivityReader.extract_data_polygon, reading the points from the cubes"""
+        if agg_operations is None:
+            agg_operations = ['sum']
+        if isinstance(agg_operations, str):
+            agg_operations = [agg_operations]
+        tables = [table_name] if isinstance(table_name, str) else list(table_name)
+
+        frames = []
+        for tab in tables:
+            chunks = []
+            for dates, values, cell_rows, cell_cols in self.iterate_days(tab, start_date, end_date, polygon):
+                iday, icell = np.nonzero(np.isfinite(values))
+                chunks.append(pd.DataFrame({'datetime': dates.values[iday],
+                                            'lon': self.lon[cell_cols[icell]],
+                                            'lat': self.lat[cell_rows[icell]],
+                                            tab.replace('_data',''): values[iday, icell].astype(np.float64)}))
+            if chunks:
+                frames.append(pd.concat(chunks).set_index(['datetime', 'lon', 'lat']))
+            else:
+                frames.append(pd.DataFrame({tab.replace('_data',''): []},
+                                           index = pd.MultiIndex.from_arrays([pd.DatetimeIndex([]), [], []],
+                                                                             names = ['datetime', 'lon', 'lat'])))
+        # wide frame keyed on (datetime, point): one column per variable
+        data = pd.concat(frames, axis = 1).reset_index(['lon', 'lat']).sort_index()
+        return self.aggregate_points(data, agg_operations, resolution, keep_separate_dates, aggregate, lean)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Copies GFAS tables from the PostGIS database into local daily cubes')
+    parser.add_argument('cube_folder')
+    parser.add_argument('--tables', nargs = '+', required = True, help = "tables to copy, e.g. 'gfas_frpfire_data'")
+    parser.add_argument('--start', required = True, help = 'first day (YYYY-MM-DD)')
+    parser.add_argument('--end', required = True, help = 'last day (YYYY-MM-DD)')
+    parser.add_argument('--database', default = None, help = 'SQLAlchemy url of the database (default: $WFDB_URL or the ECMWF one)')
+    args = parser.parse_args()
+    reader = GfasActivityReader(connection_url = args.database)
+    cube_reader = GfasCubeReader(cube_folder = args.cube_folder)
+    for table_name in args.tables:
+        cube_reader.build_from_reader(reader, table_name, args.start, args.end)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import argparse
+import datetime as dt
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+try:
+    import duckdb
+except ImportError: # optional dependency: pip install emission_explorer[parquet]
+    duckdb = None
+
+######local imports
+from emission_explorer.GfasActivityReader import GfasReaderBase, GfasActivityReader
+from emission_explorer.GfasCubeReader import points_in_polygon
+
+
+_spatial_missing = False # the 'spatial' extension could not be loaded in this process
+
+
+def install_spatial():
+    """Installs the DuckDB 'spatial' extension (downloaded once into the DuckDB extension folder, then loaded by every
+    reader). Returns False if it cannot be installed, e.g. without network: the containment is then computed in python."""
+    global _spatial_missing
+    if duckdb is None:
+        return False
+    try:
+        duckdb.connect().execute('INSTALL spatial')
+    except duckdb.Error as err:
+        print(f"The DuckDB 'spatial' extension cannot be installed ({err}), the points are selected in python.")
+        return False
+    _spatial_missing = False
+    return True
+
+
+class GfasParquetReader(GfasReaderBase):
+    """Embedded read backend: every GFAS table is stored as Parquet files partitioned by date
+    ('parquet_folder/table_name/year=YYYY/month=MM/part.parquet', columns 'datetime', 'lon', 'lat' and 'value') and
+    queried in process with DuckDB, so no PostgreSQL server is needed.
+
+    The filters on the dates prune the year/month partitions and the bounding box of the polygon is pushed down on the
+    'lon'/'lat' columns (the points are sorted by latitude in every file, so the row groups outside the box are skipped).
+    The exact containment in the polygon uses the DuckDB 'spatial' extension when it is installed (see 'install_spatial',
+    run by the export command), otherwise it is computed on the points of the bounding box. It has the same
+    'extract_data2' and 'extract_data_polygon' interface of GfasActivityReader. The files are written from the database
+    with 'export_from_reader'.
+    """
+
+    row_group_size = 100000
+
+    def __init__(self, parquet_folder = None, spatial = True):
+        if duckdb is None:
+            raise ImportError("The Parquet backend needs 'duckdb' and 'pyarrow' (pip install emission_explorer[parquet]).")
+        if parquet_folder is None:
+            raise ValueError("The 'parquet_folder' of the GFAS Parquet files is not specified.")
+        self.parquet_folder = Path(parquet_folder)
+        self.con = duckdb.connect()
+        self.lock = threading.Lock()
+        self.spatial = spatial and self.load_spatial()
+
+    def load_spatial(self):
+        """Loads the DuckDB 'spatial' extension if it is installed (once, see 'install_spatial'). Returns False if it is
+        not available: nothing is downloaded when a reader is created."""
+        global _spatial_missing
+        if _spatial_missing:
+            return False
+        try:
+            self.con.execute('LOAD spatial')
+        except duckdb.Error:
+            _spatial_missing = True # not retried by the next readers of the process
+            return False
+        return True
+
+    ########## STORAGE
+    def table_path(self, table_name):
+        return self.parquet_folder / table_name
+
+    def export_from_reader(self, reader, table_name, start_date, end_date):
+        """Copies the table 'table_name' from the PostGIS database ('reader' is a GfasActivityReader) into Parquet files,
+        one partition per month."""
+        for _, data in reader.iterate_months(table_name, start_date, end_date):
+            self.add_points(table_name, data)
+        with open(self.table_path(table_name) / 'meta.json', 'w') as dst:
+            json.dump({'table_name': table_name, 'updated': f'{dt.datetime.now():%Y-%m-%d %H:%M}'}, dst)
+
+    def add_points(self, table_name, data):
+        """Writes the points of 'data' (DataFrame with 'datetime', 'lon', 'lat' and 'value' columns) in the monthly
+        partitions. The partitions of the months in 'data' are replaced."""
+        data = data[['datetime', 'lon', 'lat', 'value']].copy()
+        data['datetime'] = pd.to_datetime(data['datetime'])
+        for (year, month), month_data in data.groupby([data.datetime.dt.year, data.datetime.dt.month]):
+            path = self.table_path(table_name) / f'year={year}' / f'month={month:02d}' / 'part.parquet'
+            path.parent.mkdir(exist_ok = True, parents = True)
+            month_data = month_data.sort_values(['lat', 'lon', 'datetime'])
+            month_data.to_parquet(path, index = False, row_group_size = self.row_group_size)
+
+    ########## SELECTION
+    def region_points(self, table_name, start_date, end_date, polygon):
+        """Returns the points (DataFrame with 'datetime', 'lon', 'lat' and 'value' columns) of 'table_name' contained
+        in 'polygon' between 'start_date' and 'end_date'"""
+        if not any(self.table_path(table_name).glob('*/*/*.parquet')):
+            return pd.DataFrame({'datetime': pd.DatetimeIndex([]), 'lon': [], 'lat': [], 'value': []})
+        files = self.table_path(table_name) / '*' / '*' / '*.parquet'
+        minx, miny, maxx, maxy = polygon.bounds
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        contains = f"AND ST_Contains(ST_GeomFromText('{polygon.wkt}'), ST_Point(lon, lat))" if self.spatial else ''
+        query = f"""SELECT datetime, lon, lat, value FROM read_parquet('{files}', hive_partitioning = true)
+                WHERE year >= $first_year AND year <= $last_year AND
+                datetime >= $start_date AND datetime <= $end_date AND
+                lon >= $minx AND lon <= $maxx AND lat >= $miny AND lat <= $maxy
+                {contains}
+                ORDER BY datetime;"""
+        params = {
+            'first_year': start_date.year,
+            'last_year': end_date.year,
+            'start_date': start_date.to_pydatetime(),
+            'end_date': end_date.to_pydatetime(),
+            'minx': minx, 'maxx': maxx, 'miny': miny, 'maxy': maxy
+        }
+        with self.lock:
+            cursor = self.con.cursor() # one cursor per query, the reader can be shared by threads
+        data = cursor.execute(query, params).df()
+        cursor.close()
+        if not self.spatial:
+            data = data[points_in_polygon(polygon, data.lon.values, data.lat.values)]
+        return data
+
+    def extract_data2(self, start_date, end_date, polygon, table_name, agg_operation = None):
+        """Same as GfasActivityReader.extract_data2: one aggregated value per day (days without fires are not returned)"""
+        sql_names = {'sum': 'sum', 'mean': 'avg', 'median': 'median', 'std': 'stddev', 'min': 'min', 'max': 'max'}
+        if agg_operation is None:
+            agg_operation = 'sum'
+        tables = [table_name] if isinstance(table_name, str) else list(table_name)
+
+        series = []
+        for tab in tables:
+            points = self.region_points(tab, start_date, end_date, polygon)
+            name = sql_names[agg_operation] if isinstance(table_name, str) else tab.replace('_data','')
+            # std: same as the SQL stddev (sample standard deviation, the pandas default)
+            series.append(points.groupby('datetime')['value'].agg(agg_operation).astype(np.float64).rename(name))
+        data = pd.concat(series, axis = 1)
+        data.index.name = 'datetime'
+        return data.sort_index()
+
+    def extract_data_polygon(self, table_name, start_date, end_date, polygon, agg_operations = None, resolution = 0.1, keep_separate_dates = True, aggregate = True, lean = False):
+        """Same as GfasActivityReader.extract_data_polygon, reading the points from the Parquet files"""
+        if agg_operations is None:
+            agg_operations = ['sum']
+        if isinstance(agg_operations, str):
+            agg_operations = [agg_operations]
+        tables = [table_name] if isinstance(table_name, str) else list(table_name)
+
+        frames = []
+        for tab in tables:
+            points = self.region_points(tab, start_date, end_date, polygon)
+            frames.append(points.rename(columns = {'value': tab.replace('_data','')}).set_index(['datetime', 'lon', 'lat']))
+        # wide frame keyed on (datetime, point): one column per variable
+        data = pd.concat(frames, axis = 1).reset_index(['lon', 'lat']).sort_index()
+        return self.aggregate_points(data, agg_operations, resolution, keep_separate_dates, aggregate, lean)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Exports GFAS tables from the PostGIS database into date-partitioned Parquet files')
+    parser.add_argument('parquet_folder')
+    parser.add_argument('--tables', nargs = '+', required = True, help = "tables to export, e.g. 'gfas_frpfire_data'")
+    parser.add_argument('--start', required = True, help = 'first day (YYYY-MM-DD)')
+    parser.add_argument('--end', required = True, help = 'last day (YYYY-MM-DD)')
+    parser.add_argument('--database', default = None, help = 'SQLAlchemy url of the database (default: $WFDB_URL or the ECMWF one)')
+    args = parser.parse_args()
+    reader = GfasActivityReader(connection_url = args.database)
+    parquet_reader = GfasParquetReader(parquet_folder = args.parquet_folder, spatial = False)
+    for table_name in args.tables:
+        parquet_reader.export_from_reader(reader, table_name, args.start, args.end)
+    install_spatial() # one time setup of the readers of the files
+
+
+if __name__ == '__main__':
+    main()
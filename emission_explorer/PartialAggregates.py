@@ -0,0 +1,72 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+# operations of the readers ('agg_operations') that give the partial aggregates of every cell
+PARTIAL_OPERATIONS = ['count', 'sum', 'min', 'max', 'var']
+# final operations that can be computed from the partial aggregates ('median' needs all the values)
+MERGEABLE_OPERATIONS = ['count', 'sum', 'mean', 'std', 'min', 'max']
+
+
+def partial_names(partial):
+    """Names of the variables of a frame of partial aggregates (columns '{name}_count', '{name}_sum', ...)"""
+    return [col[:-len('_count')] for col in partial.columns if col.endswith('_count')]
+
+
+def to_partial(data_aggr):
+    """Converts the output of the readers aggregated with PARTIAL_OPERATIONS (columns '{name}_count', '{name}_sum',
+    '{name}_min', '{name}_max', '{name}_var') into partial aggregates: the variance is replaced by the sum of the squared
+    differences from the mean ('{name}_m2'), which can be merged exactly."""
+    partial = data_aggr.copy()
+    for name in partial_names(partial):
+        partial[f'{name}_m2'] = (partial.pop(f'{name}_var') * (partial[f'{name}_count'] - 1)).fillna(0)
+    return partial
+
+
+def merge_partials(first, second):
+    """Merges two frames of partial aggregates (same variables, index of the cells or of (datetime, cell)). The merge is
+    associative and commutative, so chunks of dates or of cells can be combined in any order."""
+    if first.empty:
+        return second
+    if second.empty:
+        return first
+    index = first.index.union(second.index)
+    a, b = first.reindex(index), second.reindex(index)
+    merged = pd.DataFrame(index = index)
+    for name in partial_names(first):
+        na, nb = a[f'{name}_count'].fillna(0), b[f'{name}_count'].fillna(0)
+        sa, sb = a[f'{name}_sum'].fillna(0), b[f'{name}_sum'].fillna(0)
+        count = na + nb
+        delta = (sb/nb.where(nb > 0) - sa/na.where(na > 0)).fillna(0)
+        merged[f'{name}_count'] = count
+        merged[f'{name}_sum'] = sa + sb
+        merged[f'{name}_min'] = np.fmin(a[f'{name}_min'], b[f'{name}_min'])
+        merged[f'{name}_max'] = np.fmax(a[f'{name}_max'], b[f'{name}_max'])
+        # parallel update of the sum of squared differences (Chan et al.)
+        merged[f'{name}_m2'] = a[f'{name}_m2'].fillna(0) + b[f'{name}_m2'].fillna(0) + delta**2 * na*nb/count.where(count > 0)
+    if 'geometry' in first.columns:
+        geometry = a['geometry'].copy()
+        missing = geometry.isna()
+        geometry[missing] = b['geometry'][missing]
+        merged = gpd.GeoDataFrame(merged, geometry = geometry, crs = 'EPSG:4326')
+    return merged
+
+
+def finalize(partial, operation):
+    """Final aggregates (columns '{name}_{operation}', like the readers) of a frame of partial aggregates"""
+    if operation not in MERGEABLE_OPERATIONS:
+        raise ValueError(f"The operation '{operation}' cannot be computed from partial aggregates, use any of {MERGEABLE_OPERATIONS}")
+    data = pd.DataFrame(index = partial.index)
+    for name in partial_names(partial):
+        count = partial[f'{name}_count']
+        # cells without values of this variable (more variables queried together) stay missing
+        if operation == 'mean':
+            data[f'{name}_mean'] = partial[f'{name}_sum'] / count
+        elif operation == 'std': # sample standard deviation, same as pandas and the SQL stddev
+            data[f'{name}_std'] = np.sqrt(partial[f'{name}_m2'] / (count - 1).where(count > 1))
+        else:
+            data[f'{name}_{operation}'] = partial[f'{name}_{operation}']
+        data[f'{name}_{operation}'] = data[f'{name}_{operation}'].where(count > 0)
+    if 'geometry' in partial.columns:
+        data = gpd.GeoDataFrame(data, geometry = partial['geometry'], crs = 'EPSG:4326')
+    return data
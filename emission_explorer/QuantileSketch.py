@@ -0,0 +1,108 @@
+import numpy as np
+
+
+class QuantileSketch(object):
+    """Mergeable streaming sketch of the quantiles of a set of values (deterministic KLL/MRL compactor hierarchy), used
+    to compute the quantile color bins of the 2D plots once per run instead of sorting every cell-day value at every draw.
+
+    The values are added in chunks with 'update' (e.g. one day at a time) and two sketches are combined with 'merge'
+    (e.g. different regions or chunks of dates). Level 'h' keeps at most 'k' values of weight 2**h: when it is full it
+    is sorted and every other value (alternating the starting one) moves to level h+1. Every compaction at level 'h'
+    changes the rank of any value by at most 2**h, so the sum of these weights ('self.error') is a guaranteed bound of
+    the rank error: 'rank_error()' is the bound as a fraction of the number of values, i.e. the value returned for the
+    quantile q has a true quantile within q +/- rank_error(). The memory used is about k*log2(n/k) values.
+    """
+
+    def __init__(self, k: int = 1000) -> None:
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.offsets = [0] # starting item of the next compaction of every level (alternating 0/1)
+        self.n = 0
+        self.error = 0 # upper bound of the absolute rank error
+        self.vmin = np.inf
+        self.vmax = -np.inf
+
+    @classmethod
+    def from_values(cls, values, k: int = 1000, chunk_size: int = 1000000):
+        """Sketch of an array of values, added in chunks of 'chunk_size'"""
+        values = np.asarray(values, dtype = np.float64)
+        sketch = cls(k = k)
+        for start in range(0, len(values), chunk_size):
+            sketch.update(values[start:start + chunk_size])
+        return sketch
+
+    def update(self, values):
+        """Adds the finite values of 'values' to the sketch"""
+        values = np.asarray(values, dtype = np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.n += len(values)
+        self.vmin = min(self.vmin, values.min())
+        self.vmax = max(self.vmax, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        return self
+
+    def merge(self, other):
+        """Adds the values of another sketch (the error bounds are summed)"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+            self.offsets.append(0)
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.n += other.n
+        self.error += other.error
+        self.vmin = min(self.vmin, other.vmin)
+        self.vmax = max(self.vmax, other.vmax)
+        self.compress()
+        return self
+
+    def compress(self):
+        h = 0
+        while h < len(self.levels):
+            items = self.levels[h]
+            if len(items) >= self.k:
+                items = np.sort(items)
+                # an odd item (the largest) stays at this level
+                keep = items[len(items) - len(items) % 2:]
+                promoted = items[self.offsets[h]:len(items) - len(items) % 2:2]
+                self.offsets[h] = 1 - self.offsets[h]
+                self.error += 2**h
+                self.levels[h] = keep
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self.offsets.append(0)
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def rank_error(self):
+        """Guaranteed bound of the rank error of the quantiles, as a fraction of the number of values"""
+        return self.error / self.n if self.n else 0
+
+    def quantile(self, q):
+        """Approximate quantiles 'q' (scalar or array in [0, 1]) of the values added"""
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2**h) for h, items in enumerate(self.levels)])
+        order = np.argsort(values, kind = 'stable')
+        values, cumulative = values[order], np.cumsum(weights[order])
+        ranks = np.asarray(q, dtype = np.float64) * cumulative[-1]
+        index = np.clip(np.searchsorted(cumulative, ranks, side = 'left'), 0, len(values) - 1)
+        result = values[index]
+        # the extremes are known exactly
+        result = np.where(np.asarray(q) <= 0, self.vmin, np.where(np.asarray(q) >= 1, self.vmax, result))
+        return result
+
+    def bins(self, k: int = 10):
+        """Upper bounds of 'k' quantile classes (same definition of mapclassify.Quantiles, the last one is the maximum),
+        to be used with scheme = 'User_Defined'"""
+        return np.unique(self.quantile(np.arange(1, k + 1) / k))
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return (f'QuantileSketch(n = {self.n}, k = {self.k}, stored = {sum(len(items) for items in self.levels)}, '
+                f'rank error <= {self.rank_error():.2%})')
@@ -0,0 +1,167 @@
+import argparse
+import datetime as dt
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+from sqlalchemy import text
+
+######local imports
+from emission_explorer.GfasActivityReader import DEFAULT_CONNECTION_URL, get_engine
+
+
+def table_indexes(engine, table_name):
+    """Returns the definitions of the indexes of 'table_name' (lowercase 'CREATE INDEX ...' statements)"""
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT indexdef FROM pg_indexes WHERE tablename = :table_name"),
+                            {'table_name': table_name}).fetchall()
+    return [row[0].lower() for row in rows]
+
+
+def recommend_indexes(table_name, indexdefs):
+    """Returns the (reason, statements) of the indexes missing from a GFAS table, given the definitions of its indexes:
+     - GiST on 'geom': used by ST_Contains (and &&) to select the points of the region.
+     - BRIN on 'datetime': very small index for the date filters, the tables are appended in time order.
+     - GiST on (datetime, geom) (btree_gist extension): both filters resolved by a single index scan."""
+    def has_index(method, columns):
+        pattern = rf"using {method} \({', '.join(columns)}[,)]"
+        return any(re.search(pattern, indexdef) for indexdef in indexdefs)
+
+    recommendations = []
+    if not (has_index('gist', ['geom']) or has_index('gist', ['datetime', 'geom'])):
+        recommendations.append(("no GiST index on 'geom': ST_Contains scans every point of the dates selected",
+                                [f"CREATE INDEX IF NOT EXISTS {table_name}_geom_gist ON {table_name} USING gist (geom)"]))
+    if not (has_index('brin', ['datetime']) or has_index('btree', ['datetime']) or has_index('gist', ['datetime', 'geom'])):
+        recommendations.append(("no index on 'datetime': the date filter scans the whole table",
+                                [f"CREATE INDEX IF NOT EXISTS {table_name}_datetime_brin ON {table_name} USING brin (datetime)"]))
+    if not has_index('gist', ['datetime', 'geom']):
+        recommendations.append(("no composite index on (datetime, geom): dates and region are filtered by separate indexes",
+                                ["CREATE EXTENSION IF NOT EXISTS btree_gist",
+                                 f"CREATE INDEX IF NOT EXISTS {table_name}_datetime_geom_gist ON {table_name} USING gist (datetime, geom)"]))
+    return recommendations
+
+
+class QueryDiagnostics(object):
+    """Captures the plan of every SQL query of a GfasActivityReader with EXPLAIN (ANALYZE, BUFFERS) and stores it as JSON
+    in 'plan_folder' ('output_folder/query_plans' when enabled with 'diagnostics: True' in the config file).
+
+    Every plan is checked for:
+     - sequential scans of the GFAS tables (the filters on the dates or on the region do not use an index),
+     - bad row estimates of the table scans (planned and actual rows differ more than 'estimate_factor' times, i.e.
+       stale statistics),
+     - missing indexes of the tables scanned sequentially (see 'recommend_indexes' and the index advisor command).
+    The warnings are printed and saved with the plan. Note that EXPLAIN ANALYZE runs the query, so with the diagnostics
+    enabled every extraction is executed twice.
+    """
+
+    estimate_factor = 10
+
+    def __init__(self, plan_folder = None) -> None:
+        if plan_folder is None:
+            plan_folder = Path.cwd() / 'query_plans'
+        self.plan_folder = Path(plan_folder)
+        self.plan_folder.mkdir(exist_ok = True, parents = True)
+        self.lock = threading.Lock()
+        self.reports = []
+
+    def explain(self, engine, query, params, connection = None):
+        """Runs EXPLAIN (ANALYZE, BUFFERS) of 'query' (same parameters) and saves the plan and its warnings. Returns the
+        warnings. With 'connection' the EXPLAIN runs in its transaction (e.g. with the statement timeout of the query),
+        otherwise on a new connection of 'engine'."""
+        explain_query = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query.strip().rstrip(';')
+        if connection is not None:
+            plan = connection.exec_driver_sql(explain_query, params).scalar()
+        else:
+            with engine.connect() as conn:
+                plan = conn.exec_driver_sql(explain_query, params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        warnings = self.analyze_plan(plan[0]['Plan'])
+        warnings += self.missing_indexes(engine, plan[0]['Plan'])
+
+        with self.lock:
+            number = len(self.reports) + 1
+            report = {'query': query, 'params': {name: str(value) for name, value in params.items()},
+                      'planning_time_ms': plan[0].get('Planning Time'), 'execution_time_ms': plan[0].get('Execution Time'),
+                      'warnings': warnings, 'plan': plan}
+            # the numbers are per process: the pid keeps apart the plans of the workers (see 'ChunkedAggregation')
+            path = self.plan_folder / f"plan_{dt.datetime.now().strftime(format='%H%M%S')}_{os.getpid()}_{number:03d}.json"
+            with open(path, 'w') as dst:
+                json.dump(report, dst, indent = 2, default = str)
+            self.reports.append((path, report))
+        print(f"QUERY PLAN {path.name}: {report['execution_time_ms']} ms, {len(warnings)} warnings")
+        for warning in warnings:
+            print(f'   WARNING: {warning}')
+        return warnings
+
+    def iterate_nodes(self, node):
+        yield node
+        for child in node.get('Plans', []):
+            yield from self.iterate_nodes(child)
+
+    def analyze_plan(self, plan):
+        """Returns the warnings (sequential scans, bad row estimates) of the nodes of a JSON plan"""
+        warnings = []
+        for node in self.iterate_nodes(plan):
+            relation = node.get('Relation Name', '')
+            if (node['Node Type'] == 'Seq Scan') and relation.startswith('gfas_'):
+                filters = node.get('Filter', '')
+                warnings.append(f"sequential scan on {relation} (filter: {filters or 'none'}, "
+                                f"rows removed: {node.get('Rows Removed by Filter', 'n/a')})")
+            if relation and ('Actual Rows' in node):
+                planned = max(node['Plan Rows'], 1)
+                actual = max(node['Actual Rows'], 1)
+                if max(planned/actual, actual/planned) > self.estimate_factor:
+                    warnings.append(f"bad row estimate on {node['Node Type']} {relation}: planned {node['Plan Rows']}, "
+                                    f"actual {node['Actual Rows']} (run ANALYZE {relation})")
+        return warnings
+
+    def missing_indexes(self, engine, plan):
+        """Returns the warnings of the missing indexes of the GFAS tables scanned sequentially in the plan"""
+        tables = {node['Relation Name'] for node in self.iterate_nodes(plan)
+                  if (node['Node Type'] == 'Seq Scan') and node.get('Relation Name', '').startswith('gfas_')}
+        warnings = []
+        for table_name in sorted(tables):
+            for reason, statements in recommend_indexes(table_name, table_indexes(engine, table_name)):
+                warnings.append(f"missing index on {table_name}, {reason}: {'; '.join(statements)}")
+        return warnings
+
+    def summary(self):
+        n_warnings = sum(len(report['warnings']) for _, report in self.reports)
+        return f"DIAGNOSTICS SUMMARY: {len(self.reports)} query plans saved in {self.plan_folder}, {n_warnings} warnings"
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Checks the indexes of the GFAS tables of the PostGIS database and recommends (or creates) the missing ones')
+    parser.add_argument('--tables', nargs = '+', default = None, help = "tables to check (default: every 'gfas_*_data' table)")
+    parser.add_argument('--database', default = None, help = 'SQLAlchemy url of the database (default: $WFDB_URL or the ECMWF one)')
+    parser.add_argument('--create', action = 'store_true', help = 'create the missing indexes (and run ANALYZE on the tables)')
+    args = parser.parse_args()
+    connection_url = args.database if args.database is not None else os.environ.get('WFDB_URL', DEFAULT_CONNECTION_URL)
+    engine = get_engine(connection_url)
+
+    tables = args.tables
+    if tables is None:
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT tablename FROM pg_tables WHERE tablename LIKE 'gfas\\_%\\_data' ORDER BY tablename")).fetchall()
+        tables = [row[0] for row in rows]
+    for table_name in tables:
+        recommendations = recommend_indexes(table_name, table_indexes(engine, table_name))
+        print(f'{table_name}: {len(recommendations)} missing indexes')
+        for reason, statements in recommendations:
+            print(f'   {reason}')
+            for statement in statements:
+                print(f'      {statement};')
+        if args.create and recommendations:
+            with engine.begin() as conn:
+                for _, statements in recommendations:
+                    for statement in statements:
+                        conn.execute(text(statement))
+                conn.execute(text(f'ANALYZE {table_name}'))
+            print(f'   created, ANALYZE {table_name} done')
+
+
+if __name__ == '__main__':
+    main()
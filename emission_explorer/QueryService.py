@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import matplotlib
+import matplotlib.pyplot as plt
+
+######local imports
+from emission_explorer.data_handler import config_file, query_data, plot_data
+from emission_explorer.ResultCache import ResultCache
+
+
+class QueryService(object):
+    """Long-lived HTTP service (asyncio) that runs the config_file -> query_data -> plot_data chain for configurations
+    received as JSON payloads (the query keys of the yaml config file, see 'payload_keys').
+
+    The database engine, the boundary shapes (see 'data_handler.load_boundaries') and the 'ResultCache' stay in memory
+    between requests. The blocking work runs in a pool of 'max_workers' threads, the plots are rendered one at a time
+    (matplotlib is not thread safe) and identical requests received while the first one is still running are coalesced
+    (they all wait for the same result).
+
+    Endpoints:
+     - GET  /health: {"status": "ok"}
+     - GET  /stats : cache and requests statistics
+     - POST /data  : data of every geometry and variable as JSON ('format': 'csv' for a single geometry/variable)
+     - POST /plot  : rendered plot of the first geometry and variable (PNG, MP4 for '2D Animated Plot')
+     - POST /cancel: cancels the running queries of a config (same payload), or all of them with an empty payload
+
+    With a 'deadline' in the payload (see 'query_data.create_dataset_query') a query over the budget returns an
+    approximate preview, marked by the 'X-Preview' header ('sample_percent=1; total_relative_error=0.0123'); the exact
+    query continues in the background and fills the cache, so the same request sent later returns the exact data.
+
+    The data source is an option of the service, never of the payloads: 'reader_factory' creates the reader used by
+    every query, by default the reader of 'backend' (see 'data_handler.create_reader') on the database 'connection_url'
+    (default: $WFDB_URL or the ECMWF one, it can point to a local stand-in database), or on the local 'cube_folder' or
+    'parquet_folder'. The payloads with other keys than 'payload_keys' (data source, output folders, diagnostics,
+    incremental state, worker processes) are rejected.
+    """
+
+    chunk_size = 64*1024
+    # keys of the payloads: what to query and how to plot it
+    payload_keys = ('variable', 'geometry', 'polygon_type', 'plot_type', 'aggregating_operation', 'resolution',
+                    'specific_start_date', 'specific_end_date', 'reference_start_date', 'reference_end_date',
+                    'memory_lean', 'deadline', 'preview_sample_percent', 'preview_budget', 'format', 'dpi')
+
+    def __init__(self,
+                 host: str = '127.0.0.1',
+                 port: int = 8050,
+                 result_cache: ResultCache = None,
+                 max_workers: int = 4,
+                 connection_url: str = None,
+                 reader_factory = None,
+                 backend: str = 'postgis',
+                 cube_folder: str = None,
+                 parquet_folder: str = None) -> None:
+        self.host = host
+        self.port = port
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.render_lock = threading.Lock()
+        # data source of every query (see 'data_handler.create_reader' and 'data_handler.data_source')
+        self.source_config = dict(backend = backend, database_url = connection_url, cube_folder = cube_folder,
+                                  parquet_folder = parquet_folder)
+        self.reader_factory = reader_factory
+        self.inflight = {} # request hash -> asyncio.Future
+        self.running = {} # config hash -> query_data running (or with an exact query in the background)
+        self.running_lock = threading.Lock()
+        self.stats = dict(requests = 0, coalesced = 0, errors = 0, previews = 0, cancelled = 0)
+
+    ########## WORK (runs in the thread pool)
+    def check_payload(self, payload):
+        """Returns the payload if it is a dictionary with only 'payload_keys', raises ValueError otherwise"""
+        if not isinstance(payload, dict):
+            raise ValueError('The payload must be a JSON object with the keys of the config.')
+        rejected = sorted(set(payload) - set(self.payload_keys))
+        if rejected:
+            raise ValueError(f"The keys {rejected} cannot be set by the payload, only {list(self.payload_keys)} "
+                             "(the data source and the output folders are options of the service).")
+        return payload
+
+    def config_hash(self, payload):
+        """Hash of the config of a payload (the output options 'format' and 'dpi' are not part of it)"""
+        return self.request_hash('config', {key: value for key, value in payload.items() if key not in ['format', 'dpi']})
+
+    def run_query(self, payload):
+        """Returns {geometry name: {variable: data}} for the config in 'payload', and the preview information (None if
+        the data are exact, see 'query_data.preview')"""
+        cf = config_file(TOTAL_CONFIG = dict(payload, **self.source_config))
+        config = cf.TOTAL_CONFIG
+        hh = self.config_hash(payload)
+        results = {}
+        preview = None
+        for geom, cname in zip(config['geometry'], cf.countryname):
+            config2 = config.copy()
+            config2.update({'geometry':geom})
+            qd = self.running_exact(hh, geom)
+            if qd is not None: # same preview until the exact query running in the background replaces it
+                qd_preview, qd_data = qd.preview, qd.data
+            else:
+                db = self.reader_factory() if self.reader_factory is not None else None
+                # the query_data stays registered (cancellable) while its exact query runs in the background
+                qd = query_data(config2, extraction_cache = self.result_cache, db = db, run_query = False,
+                                on_exact = lambda qd, hh = hh: self.unregister(hh, qd))
+                with self.running_lock:
+                    self.running.setdefault(hh, []).append(qd)
+                try:
+                    qd.data = qd.create_dataset_query()
+                finally:
+                    if not qd.is_running():
+                        self.unregister(hh, qd)
+                qd_preview, qd_data = qd.preview, qd.data
+            if qd_preview is not None:
+                preview = qd_preview
+            results[cname] = (config2, qd.table_database, qd.split_by_variable(qd_data))
+        if preview is not None:
+            self.count('previews')
+        return results, preview
+
+    def running_exact(self, hh, geom):
+        """Returns the query_data of the config 'hh' and geometry 'geom' whose exact query still runs in the background
+        (None if there is none): the following requests reuse its preview instead of starting new ones."""
+        with self.running_lock:
+            for qd in self.running.get(hh, []):
+                if qd.is_running() and qd.TOTAL_CONFIG['geometry'].equals(geom):
+                    return qd
+        return None
+
+    def count(self, name, number = 1):
+        """Adds 'number' to the statistic 'name' (updated by the event loop and by the worker threads)"""
+        with self.running_lock:
+            self.stats[name] += number
+
+    def unregister(self, hh, qd):
+        with self.running_lock:
+            if qd in self.running.get(hh, []):
+                self.running[hh].remove(qd)
+            if not self.running.get(hh, True):
+                self.running.pop(hh)
+
+    def cancel(self, payload):
+        """Cancels the queries of the config in 'payload' (all the running queries if empty). Returns their number."""
+        with self.running_lock:
+            if payload:
+                running = list(self.running.pop(self.config_hash(payload), []))
+            else:
+                running = [qd for queries in self.running.values() for qd in queries]
+                self.running = {}
+        for qd in running:
+            qd.cancel()
+        self.count('cancelled', len(running))
+        return len(running)
+
+    @staticmethod
+    def preview_headers(preview):
+        if preview is None:
+            return {}
+        return {'X-Preview': f"sample_percent={preview['sample_percent']:g}; total_relative_error={preview['relative_error']:.4g}"}
+
+    def render_data(self, payload):
+        results, preview = self.run_query(payload)
+        if payload.get('format', 'json') == 'csv':
+            frames = [data for _, _, split in results.values() for data in split.values()]
+            if len(frames) != 1:
+                raise ValueError("The 'csv' format is only available for a single geometry and variable.")
+            return 'text/csv', frames[0].to_csv().encode(), self.preview_headers(preview)
+        output = {}
+        for cname, (_, _, split) in results.items():
+            output[cname] = {}
+            for var, data in split.items():
+                if 'geometry' in data.columns:
+                    output[cname][var] = json.loads(data.to_json())
+                else:
+                    output[cname][var] = json.loads(data.to_json(orient = 'split', date_format = 'iso'))
+        return 'application/json', json.dumps(output).encode(), self.preview_headers(preview)
+
+    def render_plot(self, payload):
+        results, preview = self.run_query(payload)
+        cname, (config2, table_database, split) = next(iter(results.items()))
+        var, data = next(iter(split.items()))
+        config_var = config2.copy()
+        config_var.update({'variable':var})
+        with self.render_lock:
+            plod = plot_data(config_var, data, table_database, display_animation = False, preview = preview)
+            try:
+                plod.create_plot_type(cname)
+                if config_var['plot_type'] == '2D Animated Plot':
+                    with tempfile.TemporaryDirectory() as tmp:
+                        outfilepath = Path(tmp) / 'animation.mp4'
+                        plod.anim.save(outfilepath)
+                        return 'video/mp4', outfilepath.read_bytes(), self.preview_headers(preview)
+                buffer = io.BytesIO()
+                plod.fig_sol.tight_layout()
+                plod.fig_sol.savefig(buffer, format = 'png', dpi = payload.get('dpi', 150), facecolor = 'w')
+                return 'image/png', buffer.getvalue(), self.preview_headers(preview)
+            finally:
+                plt.close(plod.fig_sol)
+
+    ########## HTTP
+    @staticmethod
+    def request_hash(path, payload):
+        return hashlib.sha256(json.dumps([path, payload], sort_keys = True, default = str).encode()).hexdigest()
+
+    async def coalesce(self, path, payload, function):
+        """Runs 'function(payload)' in the thread pool, unless the same request is already running"""
+        hh = self.request_hash(path, payload)
+        if hh in self.inflight:
+            self.count('coalesced')
+            return await asyncio.shield(self.inflight[hh])
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, function, payload)
+        self.inflight[hh] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self.inflight.pop(hh, None)
+
+    async def handle(self, method, path, body):
+        """Returns (status, content type, body, extra headers) of a request"""
+        if (method == 'GET') and (path == '/health'):
+            return 200, 'application/json', json.dumps({'status': 'ok'}).encode(), {}
+        if (method == 'GET') and (path == '/stats'):
+            with self.running_lock:
+                stats = dict(self.stats, inflight = len(self.inflight), running = sum(len(qds) for qds in self.running.values()))
+            stats.update(cache = self.result_cache.stats, cache_summary = self.result_cache.summary())
+            return 200, 'application/json', json.dumps(stats).encode(), {}
+        if (method == 'POST') and (path in ['/data', '/plot']):
+            payload = self.check_payload(json.loads(body.decode() or '{}'))
+            function = self.render_data if path == '/data' else self.render_plot
+            content_type, content, headers = await self.coalesce(path, payload, function)
+            return 200, content_type, content, headers
+        if (method == 'POST') and (path == '/cancel'):
+            cancelled = self.cancel(self.check_payload(json.loads(body.decode() or '{}')))
+            return 200, 'application/json', json.dumps({'cancelled': cancelled}).encode(), {}
+        return 404, 'application/json', json.dumps({'error': f'{method} {path} not found'}).encode(), {}
+
+    @staticmethod
+    def error_status(err):
+        """HTTP status of an error: 400 for the malformed requests and payloads, 504 for the queries over their time
+        limit, 500 for the rest (database errors, cancelled queries, ...)"""
+        if isinstance(err, (ValueError, KeyError, UnicodeDecodeError, asyncio.IncompleteReadError)):
+            return 400
+        if isinstance(err, TimeoutError):
+            return 504
+        return 500
+
+    async def read_request(self, reader):
+        """Returns the method, path and body of an HTTP request (None if the connection is closed without request),
+        raises ValueError if it is malformed"""
+        request_line = (await reader.readline()).decode().strip()
+        if not request_line:
+            return None
+        parts = request_line.split(' ')
+        if len(parts) < 2:
+            raise ValueError(f'Malformed request line: {request_line!r}')
+        method, path = parts[0:2]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            if ':' not in line:
+                raise ValueError(f'Malformed header: {line!r}')
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return method, path.split('?')[0], body
+
+    async def handle_connection(self, reader, writer):
+        try:
+            try:
+                request = await self.read_request(reader)
+                if request is None:
+                    return
+                self.count('requests')
+                status, content_type, content, headers = await self.handle(*request)
+            except Exception as err:
+                self.count('errors')
+                status, content_type, content, headers = self.error_status(err), 'application/json', json.dumps({'error': str(err)}).encode(), {}
+            reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error', 504: 'Gateway Timeout'}[status]
+            extra = ''.join([f'{name}: {value}\r\n' for name, value in headers.items()])
+            writer.write((f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n{extra}'
+                          f'Content-Length: {len(content)}\r\nConnection: close\r\n\r\n').encode())
+            # stream the content back in chunks
+            for start in range(0, len(content), self.chunk_size):
+                writer.write(content[start:start+self.chunk_size])
+                await writer.drain()
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f'Wildfire explorer service listening on http://{self.host}:{self.port}')
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        matplotlib.use('Agg') # no display in the service
+        asyncio.run(self.serve())
+
+
+def post_config(config, endpoint = 'data', url = 'http://127.0.0.1:8050'):
+    """Sends a config (dictionary with the query keys of the yaml file, see 'QueryService.payload_keys') to a running
+    QueryService, e.g. from the GUI.
+    Returns the decoded JSON for the 'data' endpoint, the raw bytes (PNG/MP4) for the 'plot' endpoint."""
+    request = urllib.request.Request(f'{url}/{endpoint}', data = json.dumps(config, default = str).encode(),
+                                     headers = {'Content-Type': 'application/json'}, method = 'POST')
+    with urllib.request.urlopen(request) as response:
+        content = response.read()
+    if endpoint == 'data' and config.get('format', 'json') == 'json':
+        return json.loads(content)
+    return content
+
+
+def cancel_config(config = None, url = 'http://127.0.0.1:8050'):
+    """Cancels the running queries of a config sent to a running QueryService (all of them if 'config' is None), e.g.
+    from a cancel button of the GUI. Returns the number of queries cancelled."""
+    request = urllib.request.Request(f'{url}/cancel', data = json.dumps(config or {}, default = str).encode(),
+                                     headers = {'Content-Type': 'application/json'}, method = 'POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())['cancelled']
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Wildfire explorer query service')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', default = 8050, type = int)
+    parser.add_argument('--workers', default = 4, type = int, help = 'number of queries running at the same time')
+    parser.add_argument('--database', default = None, help = 'SQLAlchemy url of the database (default: $WFDB_URL or the ECMWF one)')
+    parser.add_argument('--backend', default = 'postgis', choices = ['postgis', 'cube', 'parquet'], help = 'where the data are read')
+    parser.add_argument('--cube-folder', default = None, help = 'folder of the local cubes (--backend cube)')
+    parser.add_argument('--parquet-folder', default = None, help = 'folder of the Parquet files (--backend parquet)')
+    parser.add_argument('--cache-folder', default = None, help = 'folder of the on-disk result cache')
+    parser.add_argument('--cache-max-memory-mb', default = 1024, type = float)
+    args = parser.parse_args()
+    result_cache = ResultCache(cache_folder = args.cache_folder, max_memory_mb = args.cache_max_memory_mb)
+    QueryService(host = args.host, port = args.port, result_cache = result_cache, max_workers = args.workers,
+                 connection_url = args.database, backend = args.backend, cube_folder = args.cube_folder,
+                 parquet_folder = args.parquet_folder).run()
+
+
+if __name__ == '__main__':
+    main()
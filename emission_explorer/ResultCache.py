@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class ResultCache(object):
+    """Content-addressed cache of the database extractions of 'query_data.extract_data'.
+
+    The entries are identified by the normalized extraction key of 'query_data.extraction_key' (variable table,
+    geometry WKB digest, dates, aggregating operation, 2D/1D mode) and kept in two tiers:
+     - memory: an LRU dictionary limited to 'max_memory_mb'.
+     - disk (only if 'cache_folder' is given): one pickle per entry, LRU eviction (by access time) above 'max_disk_mb'.
+    Entries older than 'ttl_hours' are considered expired. The cache can be used in place of the plain dictionary
+    accepted by 'query_data(extraction_cache = ...)'.
+    """
+
+    def __init__(self,
+                 cache_folder: str = None,
+                 max_memory_mb: float = 512,
+                 max_disk_mb: float = 4096,
+                 ttl_hours: float = None) -> None:
+        self.cache_folder = Path(cache_folder) if cache_folder is not None else None
+        if self.cache_folder is not None:
+            self.cache_folder.mkdir(exist_ok = True, parents = True)
+        self.max_memory_bytes = max_memory_mb * 1024**2
+        self.max_disk_bytes = max_disk_mb * 1024**2
+        self.ttl = ttl_hours * 3600 if ttl_hours is not None else None
+
+        self.lock = threading.RLock() # the cache can be shared by concurrent queries (see 'QueryService')
+        self.memory = OrderedDict() # hash -> (key, created, nbytes, value)
+        self.memory_bytes = 0
+        self.invalidation_hooks = []
+        self.stats = dict(memory_hits = 0, disk_hits = 0, misses = 0, evictions = 0, expired = 0, invalidated = 0)
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the cache from the (optional) 'cache_*' keys of the config file"""
+        return cls(cache_folder = config.get('cache_folder', None),
+                   max_memory_mb = config.get('cache_max_memory_mb', 512),
+                   max_disk_mb = config.get('cache_max_disk_mb', 4096),
+                   ttl_hours = config.get('cache_ttl_hours', None))
+
+    @staticmethod
+    def hash_key(key):
+        """Normalized hash of an extraction key (tuple of (name, value) pairs)"""
+        normalized = json.dumps({name: list(value) if isinstance(value, tuple) else value for name, value in key},
+                                sort_keys = True, default = str)
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    @staticmethod
+    def size_of(value):
+        """Approximate size in bytes of a cached extraction (data, first_date, last_date)"""
+        data = value[0] if isinstance(value, tuple) else value
+        if hasattr(data, 'memory_usage'):
+            return int(data.memory_usage(deep = True).sum())
+        return len(pickle.dumps(value))
+
+    def add_invalidation_hook(self, hook):
+        """Adds a function 'hook(key_fields: dict, created: float) -> bool' called on every lookup: when it returns True
+        the entry is considered stale and removed (e.g. if the table was updated after 'created')."""
+        self.invalidation_hooks.append(hook)
+
+    def is_valid(self, key, created, count = True):
+        if (self.ttl is not None) and (time.time() - created > self.ttl):
+            if count:
+                self.stats['expired'] += 1
+            return False
+        if any(hook(dict(key), created) for hook in self.invalidation_hooks):
+            if count:
+                self.stats['invalidated'] += 1
+            return False
+        return True
+
+    def load_disk(self, path):
+        """Reads a disk entry (key, created, value), a truncated or unreadable file is removed and treated as a miss"""
+        try:
+            with open(path, 'rb') as src:
+                return pickle.load(src)
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            print(f"CACHE: removing the unreadable entry {path.name} ({type(err).__name__}: {err})")
+            path.unlink(missing_ok = True)
+            return None
+
+    def get(self, key, default = None):
+        with self.lock:
+            hh = self.hash_key(key)
+            # MEMORY
+            if hh in self.memory:
+                key_stored, created, nbytes, value = self.memory[hh]
+                if self.is_valid(key_stored, created):
+                    self.memory.move_to_end(hh)
+                    self.stats['memory_hits'] += 1
+                    return value
+                self.remove(hh)
+            # DISK
+            path = self.disk_path(hh)
+            entry = self.load_disk(path) if path is not None else None
+            if entry is not None:
+                key_stored, created, value = entry
+                if self.is_valid(key_stored, created):
+                    os.utime(path) # last access time used for the LRU eviction
+                    self.stats['disk_hits'] += 1
+                    self.put_memory(hh, key_stored, created, value)
+                    return value
+                self.remove(hh)
+            self.stats['misses'] += 1
+            return default
+
+    def __contains__(self, key):
+        """Whether a valid entry exists, without changing the statistics, the LRU order or the access times"""
+        with self.lock:
+            hh = self.hash_key(key)
+            if hh in self.memory:
+                key_stored, created, _, _ = self.memory[hh]
+                if self.is_valid(key_stored, created, count = False):
+                    return True
+            path = self.disk_path(hh)
+            entry = self.load_disk(path) if path is not None else None
+            return (entry is not None) and self.is_valid(entry[0], entry[1], count = False)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            hh = self.hash_key(key)
+            created = time.time()
+            self.put_memory(hh, key, created, value)
+            path = self.disk_path(hh)
+            if path is not None:
+                # written aside then renamed: a reader never sees a partial entry
+                tmp = path.with_name(f'{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp')
+                try:
+                    with open(tmp, 'wb') as dst:
+                        pickle.dump((key, created, value), dst, protocol = pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp, path)
+                finally:
+                    tmp.unlink(missing_ok = True)
+                self.evict_disk()
+
+    def put_memory(self, hh, key, created, value):
+        if hh in self.memory:
+            self.memory_bytes -= self.memory.pop(hh)[2]
+        nbytes = self.size_of(value)
+        self.memory[hh] = (key, created, nbytes, value)
+        self.memory_bytes += nbytes
+        # LRU: the first elements are the least recently used
+        while (self.memory_bytes > self.max_memory_bytes) and (len(self.memory) > 1):
+            _, (_, _, nbytes_old, _) = self.memory.popitem(last = False)
+            self.memory_bytes -= nbytes_old
+            self.stats['evictions'] += 1
+
+    def disk_path(self, hh):
+        if self.cache_folder is None:
+            return None
+        return self.cache_folder / f'{hh}.pkl'
+
+    def evict_disk(self):
+        files = sorted(self.cache_folder.glob('*.pkl'), key = lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        while (total > self.max_disk_bytes) and (len(files) > 1):
+            oldest = files.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink()
+            self.stats['evictions'] += 1
+
+    def remove(self, hh):
+        if hh in self.memory:
+            self.memory_bytes -= self.memory.pop(hh)[2]
+        path = self.disk_path(hh)
+        if (path is not None) and path.exists():
+            path.unlink()
+
+    def invalidate(self, **fields):
+        """Removes all the entries whose key matches the given fields, e.g. invalidate(table_name = 'gfas_co2fire_data')
+        removes every extraction of that table. Without arguments the whole cache is cleared."""
+        with self.lock:
+            def matches(key):
+                key = dict(key)
+                for name, value in fields.items():
+                    stored = key.get(name)
+                    if isinstance(stored, tuple) and not isinstance(value, tuple):
+                        if value not in stored:
+                            return False
+                    elif stored != value:
+                        return False
+                return True
+
+            n_removed = 0
+            for hh in [hh for hh, (key, _, _, _) in self.memory.items() if matches(key)]:
+                self.remove(hh)
+                n_removed += 1
+            if self.cache_folder is not None:
+                for path in self.cache_folder.glob('*.pkl'):
+                    entry = self.load_disk(path)
+                    if (entry is not None) and matches(entry[0]):
+                        path.unlink()
+                        n_removed += 1
+            self.stats['invalidated'] += n_removed
+            return n_removed
+
+    def summary(self):
+        """Hit/miss statistics of the cache (to be printed in the run summary)"""
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        lookups = hits + self.stats['misses']
+        ratio = hits / lookups if lookups else 0
+        return (f"CACHE SUMMARY: {hits}/{lookups} hits ({ratio:.0%}) - memory hits: {self.stats['memory_hits']}, "
+                f"disk hits: {self.stats['disk_hits']}, misses: {self.stats['misses']}, evictions: {self.stats['evictions']}, "
+                f"expired: {self.stats['expired']}, invalidated: {self.stats['invalidated']}, "
+                f"memory used: {self.memory_bytes/1024**2:.1f} MB")
@@ -3,15 +3,21 @@ from pathlib import Path
 import requests
 import io
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import zipfile
 import shutil
 
+# countries with their continent, used to add the continents to the shapefiles without them
+NATURALEARTH_COUNTRIES_URL = "https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/ne_110m_admin_0_countries.zip"
+
 class subcountrymap():
     def __init__(self, 
                  file_path_location: str = None,
                  url_to_download: str = None,
                  driver: str ='ESRI Shapefile',
-                 add_continent:bool = True) -> None:
+                 add_continent:bool = True,
+                 countries_file_location: str = None) -> None:
         
         if file_path_location is None: #use current directory as location (it will be used tosave the shapefile)
             self.file_path_location = Path.cwd() / url_to_download.split('/')[-1] #Path(f"./{url_to_download.split('/')[-1]}")
@@ -19,6 +25,7 @@ class subcountrymap():
             self.file_path_location = Path(file_path_location)
         self.driver = driver
         self.url = url_to_download 
+        self.countries_file_location = countries_file_location # countries with continent (see 'add_continent_to_shapefile')
         
         # create a self.shapefile with the data contained in 'file_path_location' or 'url_to_download'. 
         # saves final data into 'self.file_path_location'
@@ -124,36 +131,41 @@ class subcountrymap():
         
     def add_continent_to_shapefile(self):
         """When workng with 'ne_110m_admin_0_map_units.zip', since it has no continent value per country, it is added searching in the 
-        default geopandas map (also taken from naturalEarth)"""
+        Natural Earth countries ('countries_file_location', downloaded there, or in the current directory, from
+        NATURALEARTH_COUNTRIES_URL the first time).
+        The centroid of every shape is matched to the continents with a spatial join (STRtree index), so that it can be used 
+        also with higher resolution shapefiles (10m/50m or admin-1 subdivisions). The shapes that do not fall in any continent
+        are then matched through their ISO code."""
         
-        countries  = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres')).sort_values('name')
+        countries_map = subcountrymap(file_path_location = self.countries_file_location,
+                                      url_to_download = NATURALEARTH_COUNTRIES_URL, add_continent = False)
+        if not hasattr(countries_map, 'shapefile'):
+            raise RuntimeError(f'The countries shapefile with the continents could not be read or downloaded ({NATURALEARTH_COUNTRIES_URL}).')
+        countries = countries_map.shapefile.rename(columns = {'NAME': 'name', 'ISO_A3': 'iso_a3'}).sort_values('name')
         countries.index = countries.name
-        continents_roughly = countries.dissolve('continent')
+        continents_roughly = countries.dissolve('continent')[['geometry']].reset_index()
         
-        def int_with_continents(point):
-            sel = continents_roughly[continents_roughly.intersects(point)]
-            if len(sel)==0:
-        #         print(f'PROBLEM, NO CONTINENT! - {point}')
-                return 'PROBLEM'
-            if len(sel)>1:
-                print('PROBLEM, MORE continents_roughly!')
-            if len(sel)==1:
-                return sel.index.values[0]
+        centroids = gpd.GeoDataFrame(geometry = self.shapefile.geometry.centroid.values, 
+                                     index = pd.RangeIndex(len(self.shapefile)), crs = continents_roughly.crs)
+        joined = gpd.sjoin(centroids, continents_roughly, how = 'left', predicate = 'intersects')
+        if joined.index.duplicated().any():
+            print('PROBLEM, MORE continents_roughly!')
+        joined = joined[~joined.index.duplicated(keep = 'first')]
+        continent = joined['continent'].fillna('PROBLEM').to_numpy(dtype = object)
 
-        self.shapefile['continent'] = self.shapefile.geometry.centroid.apply(int_with_continents)
-        def find_continent_iso(el):
-            if el is not None:
-                sel = countries[countries.iso_a3==el]
-                if len(sel)==0:
-                    print(f'PROBLEM, NO CONTINENT! - {el}')
-#                     sel
-                if len(sel)>1:
-                    print('PROBLEM, MORE continents_roughly!')
-                if len(sel)==1:
-                    return sel.continent.values[0]
-        if 'SU_A3' in  self.shapefile.columns:
-            self.shapefile.loc[self.shapefile.continent=='PROBLEM', 'continent'] = self.shapefile.loc[self.shapefile.continent=='PROBLEM', 'SU_A3'].apply(find_continent_iso)
-        self.shapefile['continent'] = self.shapefile['continent'].values.astype(str)
+        if 'SU_A3' in self.shapefile.columns:
+            # ISO codes found more than once (e.g. '-99') are ambiguous and are not used
+            iso_counts = countries.iso_a3.value_counts()
+            iso_to_continent = {iso: cont for iso, cont in zip(countries.iso_a3, countries.continent) if iso_counts[iso]==1}
+            for i in np.flatnonzero(continent == 'PROBLEM'):
+                iso = self.shapefile['SU_A3'].iloc[i]
+                if iso is not None:
+                    if iso not in iso_counts:
+                        print(f'PROBLEM, NO CONTINENT! - {iso}')
+                    elif iso_counts[iso]>1:
+                        print('PROBLEM, MORE continents_roughly!')
+                continent[i] = iso_to_continent.get(iso)
+        self.shapefile['continent'] = continent.astype(str)
         
         columns = ['NAME_EN','continent']+[f for f in self.shapefile.columns if ('continent' not in f)&('NAME_' not in f)&('FCLASS_' not in f)&('geometry' not in f)] + ['geometry']
         self.shapefile = self.shapefile[columns]
\ No newline at end of file
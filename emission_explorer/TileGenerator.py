@@ -0,0 +1,250 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+######local imports
+from emission_explorer.QuantileSketch import QuantileSketch
+
+
+_cache_sizes = {} # cache folder -> size in bytes of its tiles, shared by every generator of the folder
+_cache_lock = threading.RLock()
+
+
+def tile_bounds(z, x, y):
+    """Returns (west, south, east, north) in degrees of the XYZ (web mercator) tile z/x/y"""
+    n = 2**z
+    west = x/n*360 - 180
+    east = (x + 1)/n*360 - 180
+    north = np.degrees(np.arctan(np.sinh(np.pi*(1 - 2*y/n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi*(1 - 2*(y + 1)/n))))
+    return west, south, east, north
+
+
+def tiles_in_bounds(z, west, south, east, north):
+    """Returns the (x, y) of the XYZ tiles of zoom 'z' that intersect the given bounds"""
+    n = 2**z
+    lat_max = 85.0511
+    def tile_y(lat):
+        lat = np.radians(np.clip(lat, -lat_max, lat_max))
+        return int(np.floor((1 - np.arcsinh(np.tan(lat))/np.pi)/2*n))
+    def tile_x(lon):
+        return int(np.floor((lon + 180)/360*n))
+    x0, x1 = max(tile_x(west), 0), min(tile_x(east), n - 1)
+    y0, y1 = max(tile_y(north), 0), min(tile_y(south), n - 1)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+class TileGenerator(object):
+    """Renders the grid output of 'GfasActivityReader.aggregate_by_cluster' (GeoDataFrame of square cells) as standard
+    XYZ PNG tiles, to be shown with an ipyleaflet 'TileLayer' instead of re-plotting the map at every pan/zoom.
+
+    The cells are rasterized once in a dense array and every tile pixel looks up its cell, so a tile costs the same at
+    any zoom level. The color classification is fixed for the whole pyramid ('bins', by default the quantiles of all the
+    values with 'k' classes from a QuantileSketch). Tiles are cached on disk in 'cache_folder/label/z/x/y.png', the least recently used ones
+    are removed when the tiles of the folder (all the labels, the size is shared by the generators) exceed 'max_cache_mb'.
+    For per-day aggregates (index 'datetime', 'clust') a 'date' has to be selected: use one generator (and 'label')
+    per day with the same 'bins'.
+    """
+
+    tile_size = 256
+
+    def __init__(self,
+                 data = None,
+                 column: str = None,
+                 cache_folder: str = None,
+                 label: str = 'layer',
+                 date = None,
+                 bins = None,
+                 k: int = 10,
+                 cmap: str = 'OrRd',
+                 max_cache_mb: float = 1024) -> None:
+        if date is not None:
+            data = data.loc[date]
+        elif isinstance(data.index, pd.MultiIndex):
+            raise ValueError("The data contains more dates, select one with 'date' (one TileGenerator per day).")
+        if column is None:
+            column = [col for col in data.columns if col != 'geometry'][0]
+        if cache_folder is None:
+            cache_folder = Path.cwd() / 'tiles_cache'
+        self.cache_folder = Path(cache_folder)
+        self.label = label
+        self.max_cache_bytes = max_cache_mb * 1024**2
+
+        data = data[np.isfinite(data[column].values.astype(np.float64))]
+        values = data[column].values.astype(np.float64)
+        if bins is None:
+            bins = QuantileSketch.from_values(values).bins(k)
+        self.bins = np.asarray(bins)
+        self.vmin = values.min() if len(values) else 0
+        colors = matplotlib.colormaps[cmap](np.linspace(0, 1, len(self.bins)))
+        self.lut = (colors*255).astype(np.uint8)
+
+        self.rasterize(data.geometry.bounds, values)
+
+    def rasterize(self, bounds, values):
+        """Dense raster (rows: latitude, cols: longitude) of the class of every cell, -1 where there is no data"""
+        self.res = float(np.round((bounds.maxx - bounds.minx).median(), 6))
+        self.x0, self.y0 = bounds.minx.min(), bounds.miny.min()
+        cols = np.round((bounds.minx.values - self.x0)/self.res).astype(np.int64)
+        rows = np.round((bounds.miny.values - self.y0)/self.res).astype(np.int64)
+        self.extent = (self.x0, self.y0, self.x0 + (cols.max() + 1)*self.res, self.y0 + (rows.max() + 1)*self.res)
+        self.raster = np.full((rows.max() + 1, cols.max() + 1), -1, dtype = np.int16)
+        self.raster[rows, cols] = self.classify(values)
+
+    def classify(self, values):
+        """Class of every value with the fixed bins (same rule of mapclassify: bins[i-1] < value <= bins[i])"""
+        classes = np.searchsorted(self.bins, values, side = 'left')
+        return np.clip(classes, 0, len(self.bins) - 1)
+
+    def render_tile(self, z, x, y):
+        """Returns the RGBA array of the tile z/x/y"""
+        n = 2**z
+        pix = (np.arange(self.tile_size) + 0.5)/self.tile_size
+        lon = (x + pix)/n*360 - 180
+        lat = np.degrees(np.arctan(np.sinh(np.pi*(1 - 2*(y + pix)/n))))
+        cols = np.floor((lon - self.x0)/self.res).astype(np.int64)
+        rows = np.floor((lat - self.y0)/self.res).astype(np.int64)
+        valid_cols = (cols >= 0) & (cols < self.raster.shape[1])
+        valid_rows = (rows >= 0) & (rows < self.raster.shape[0])
+        classes = np.full((self.tile_size, self.tile_size), -1, dtype = np.int16)
+        classes[np.ix_(valid_rows, valid_cols)] = self.raster[np.ix_(rows[valid_rows], cols[valid_cols])]
+        image = self.lut[np.clip(classes, 0, None)]
+        image[classes < 0] = 0 # transparent
+        return image
+
+    def intersects(self, z, x, y):
+        west, south, east, north = tile_bounds(z, x, y)
+        xmin, ymin, xmax, ymax = self.extent
+        return (west < xmax) & (east > xmin) & (south < ymax) & (north > ymin)
+
+    def tile_path(self, z, x, y):
+        return self.cache_folder / self.label / str(z) / str(x) / f'{y}.png'
+
+    def get_tile(self, z, x, y):
+        """Returns the path of the PNG of the tile z/x/y, rendering it if it is not in the cache"""
+        if not self.intersects(z, x, y):
+            return self.empty_tile()
+        path = self.tile_path(z, x, y)
+        if path.exists():
+            os.utime(path) # last access time used for the LRU eviction
+            return path
+        path.parent.mkdir(exist_ok = True, parents = True)
+        self.cache_size() # the folder is scanned before the new tile is written, so that it is counted once
+        tmp_path = path.with_name(f'{y}.{os.getpid()}.{threading.get_ident()}.tmp')
+        plt.imsave(tmp_path, self.render_tile(z, x, y), format = 'png')
+        with _cache_lock:
+            new = not path.exists() # the same tile can be rendered by more threads
+            os.replace(tmp_path, path)
+            if new:
+                _cache_sizes[self.cache_key()] += path.stat().st_size
+            if self.cache_size() > self.max_cache_bytes:
+                self.evict()
+        return path
+
+    def empty_tile(self):
+        path = self.cache_folder / 'empty.png'
+        if not path.exists():
+            path.parent.mkdir(exist_ok = True, parents = True)
+            plt.imsave(path, np.zeros((self.tile_size, self.tile_size, 4), dtype = np.uint8), format = 'png')
+        return path
+
+    def cache_key(self):
+        return str(self.cache_folder.resolve())
+
+    def cache_size(self):
+        """Size of the cached tiles of the folder in bytes, shared by its generators (scanned only the first time)"""
+        with _cache_lock:
+            if self.cache_key() not in _cache_sizes:
+                _cache_sizes[self.cache_key()] = sum(f.stat().st_size for f in self.cache_folder.glob('*/*/*/*.png'))
+            return _cache_sizes[self.cache_key()]
+
+    @property
+    def cache_bytes(self):
+        return self.cache_size()
+
+    def evict(self):
+        """Removes the least recently used tiles of the folder until they fit in 'max_cache_mb' (rescans the folder)"""
+        with _cache_lock:
+            files = sorted(self.cache_folder.glob('*/*/*/*.png'), key = lambda f: f.stat().st_mtime)
+            total = sum(f.stat().st_size for f in files)
+            while (total > self.max_cache_bytes) and (len(files) > 1):
+                oldest = files.pop(0)
+                total -= oldest.stat().st_size
+                oldest.unlink()
+            _cache_sizes[self.cache_key()] = total
+
+    def pregenerate(self, zooms = range(0, 8)):
+        """Renders all the tiles of the data extent for the given zoom levels. Returns the number of tiles."""
+        n_tiles = 0
+        for z in zooms:
+            for x, y in tiles_in_bounds(z, *self.extent):
+                self.get_tile(z, x, y)
+                n_tiles += 1
+        return n_tiles
+
+    def legend(self, fmt = '{:.1e}'):
+        """Returns the (label, hex color) of every class, to build the map legend"""
+        lower = np.concatenate([[self.vmin], self.bins[:-1]])
+        return [(f'{fmt.format(lo)}, {fmt.format(hi)}', matplotlib.colors.to_hex(color/255))
+                for lo, hi, color in zip(lower, self.bins, self.lut)]
+
+
+class TileServer(object):
+    """Serves the tiles of one or more TileGenerator (by 'label') on http://host:port/label/z/x/y.png from a background
+    thread, so that they can be used by an ipyleaflet TileLayer in the notebook."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8060) -> None:
+        self.host = host
+        self.port = port
+        self.generators = {}
+        self.server = None
+
+    def add(self, generator):
+        self.generators[generator.label] = generator
+        return self
+
+    def start(self):
+        generators = self.generators
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                try:
+                    label, z, x, y = parts[0], int(parts[1]), int(parts[2]), int(parts[3].replace('.png', ''))
+                    path = generators[label].get_tile(z, x, y)
+                except (KeyError, IndexError, ValueError):
+                    self.send_error(404)
+                    return
+                content = path.read_bytes()
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    def url(self, label):
+        return f'http://{self.host}:{self.port}/{label}/{{z}}/{{x}}/{{y}}.png'
+
+    def tile_layer(self, label, opacity = 0.8, max_zoom = 12):
+        """Returns the ipyleaflet TileLayer of the generator 'label'"""
+        from ipyleaflet import TileLayer
+        return TileLayer(url = self.url(label), opacity = opacity, max_zoom = max_zoom, max_native_zoom = max_zoom,
+                         name = label, attribution = 'GFAS - ECMWF')
@@ -1,17 +1,27 @@
 from shapely.geometry import Polygon, MultiPolygon, box, MultiLineString, LinearRing
 from shapely.ops import unary_union
 import yaml
+import argparse
 from pathlib import Path
 import pandas as pd
+import numpy as np
 import sys
 import datetime as dt
+import functools
+import itertools
+import os
+import hashlib
+import pickle
+import threading
+import time
 import matplotlib.pyplot as plt
 import geopandas as gpd
-import mapclassify as mc
 import matplotlib
 from matplotlib.dates import DateFormatter
 from matplotlib.animation import FuncAnimation
+from matplotlib.collections import LineCollection
 from IPython import display as ipydisplay
+from sqlalchemy.engine import make_url
 # import base64
 # import hashlib
 # from typing import Callable
@@ -21,15 +31,130 @@ from IPython import display as ipydisplay
 from emission_explorer.Shapefile import subcountrymap
 #from emission_explorer.GUI.Shapefile import subcountrymap
 # sys.path.append("..")
-from emission_explorer.GfasActivityReader import GfasActivityReader
+from emission_explorer.GfasActivityReader import GfasActivityReader, DEFAULT_CONNECTION_URL, QueryCancelled, interruptible_queries
+from emission_explorer.GfasCubeReader import GfasCubeReader
+from emission_explorer.ChunkedAggregation import extract_data_polygon_chunked
+from emission_explorer.GfasParquetReader import GfasParquetReader
+from emission_explorer.PartialAggregates import PARTIAL_OPERATIONS, MERGEABLE_OPERATIONS, to_partial, merge_partials, finalize
+from emission_explorer.QueryDiagnostics import QueryDiagnostics
+from emission_explorer.QuantileSketch import QuantileSketch
+from emission_explorer.ResultCache import ResultCache
+from emission_explorer.TileGenerator import TileGenerator
 #from emission_explorer.PostGIS import GfasActivityReader
 
 
+NATURALEARTH_URL = "https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/ne_110m_admin_0_map_units.zip"#"https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/ne_50m_admin_0_countries.zip"
+
+
+@functools.lru_cache(maxsize = None)
+def load_boundaries(file_path_location = None, url_to_download = NATURALEARTH_URL):
+    """Returns the countries and continents shapes (GeoDataFrame with the names as index). The shapefile is read
+    (or downloaded) only once per process, the same GeoDataFrame is returned to every following call: do not modify it."""
+    sbcm = subcountrymap(file_path_location = file_path_location, url_to_download = url_to_download)
+    countries  = sbcm.shapefile.copy()
+    countries.index = countries.GEOUNIT
+    all_shapes = pd.concat([countries, sbcm.continent_shapefile.copy()])[['geometry','continent']]
+    all_shapes = all_shapes.groupby(all_shapes.index).last()
+    return all_shapes
+
+
+@functools.lru_cache(maxsize = 64)
+def basemap_segments(extent, dpi = 300, width_inches = 8, file_path_location = None):
+    """Returns the boundaries of countries and continents (see 'load_boundaries') as a list of (n, 2) arrays of
+    coordinates, ready for a matplotlib LineCollection: only the parts inside 'extent' (xmin, ymin, xmax, ymax) are kept,
+    simplified to the size of a pixel of a figure 'width_inches' wide at 'dpi'. Cached per extent and resolution."""
+    xmin, ymin, xmax, ymax = extent
+    tolerance = (xmax - xmin) / (width_inches * dpi)
+    all_shapes = load_boundaries(file_path_location = file_path_location)
+    boundaries = all_shapes.boundary.clip_by_rect(xmin - tolerance, ymin - tolerance, xmax + tolerance, ymax + tolerance)
+    boundaries = boundaries[~boundaries.is_empty].simplify(tolerance, preserve_topology = False)
+    segments = []
+    for line in boundaries.explode(index_parts = False):
+        if line.geom_type == 'LineString' and not line.is_empty:
+            segments.append(np.asarray(line.coords))
+    return segments
+
+
+_cube_readers = {}
+_parquet_readers = {}
+_diagnostics = {}
+
+
+def get_diagnostics(config):
+    """Returns the QueryDiagnostics of the run of the config: the query plans are saved in 'output_folder/query_plans'"""
+    plan_folder = Path(config.get('output_folder', Path.cwd())) / 'query_plans'
+    if plan_folder not in _diagnostics:
+        _diagnostics[plan_folder] = QueryDiagnostics(plan_folder = plan_folder)
+    return _diagnostics[plan_folder]
+
+
+def create_reader(config):
+    """Returns the reader of the GFAS data selected by the (optional) 'backend' key of the config:
+     - 'postgis' (default): GfasActivityReader on the database 'database_url' (default: $WFDB_URL or the ECMWF one).
+       With 'diagnostics: True' the plan of every query is captured (see 'get_diagnostics').
+     - 'cube': GfasCubeReader on the local cubes in 'cube_folder' (one reader per folder, the polygon masks are kept).
+     - 'parquet': GfasParquetReader on the Parquet files in 'parquet_folder' (embedded DuckDB, one reader per folder)."""
+    backend = config.get('backend', 'postgis')
+    if backend == 'postgis':
+        reader = GfasActivityReader(connection_url = config.get('database_url', None))
+        if config.get('diagnostics', False):
+            reader.diagnostics = get_diagnostics(config)
+        return reader
+    if backend == 'cube':
+        if config.get('cube_folder') not in _cube_readers:
+            _cube_readers[config.get('cube_folder')] = GfasCubeReader(cube_folder = config.get('cube_folder'))
+        return _cube_readers[config.get('cube_folder')]
+    if backend == 'parquet':
+        if config.get('parquet_folder') not in _parquet_readers:
+            _parquet_readers[config.get('parquet_folder')] = GfasParquetReader(parquet_folder = config.get('parquet_folder'))
+        return _parquet_readers[config.get('parquet_folder')]
+    raise ValueError(f"The backend '{backend}' in the configuration file is not any of ['postgis', 'cube', 'parquet']")
+
+
+def create_limited_reader(config, limits = None):
+    """'create_reader' for the worker processes of the chunked extractions (picklable with functools.partial): the
+    PostGIS readers get the 'limits' of the query (see 'GfasActivityReader.with_limits', the end of the latency budget
+    is a time.monotonic() of the same machine, valid in every process)"""
+    reader = create_reader(config)
+    if limits and isinstance(reader, GfasActivityReader):
+        reader = reader.with_limits(**limits)
+    return reader
+
+
+def data_source(config, db = None):
+    """(backend, location) of the data read with the config, or with the reader 'db' when given: the database url
+    (without password) or the resolved cube/Parquet folder. It is part of the extraction keys, so that the cached
+    results of different data sources are never mixed."""
+    if isinstance(db, GfasActivityReader):
+        return ('postgis', db.conn.url.render_as_string(hide_password = True))
+    if isinstance(db, GfasCubeReader):
+        return ('cube', str(Path(db.cube_folder).resolve()))
+    if isinstance(db, GfasParquetReader):
+        return ('parquet', str(Path(db.parquet_folder).resolve()))
+    if db is not None: # other readers (e.g. a stand-in of the tests)
+        return (type(db).__name__, None)
+    backend = config.get('backend', 'postgis')
+    if backend == 'postgis':
+        url = config.get('database_url', None) or os.environ.get('WFDB_URL', DEFAULT_CONNECTION_URL)
+        return ('postgis', make_url(url).render_as_string(hide_password = True))
+    if backend == 'cube':
+        return ('cube', str(Path(config.get('cube_folder')).resolve()))
+    if backend == 'parquet':
+        return ('parquet', str(Path(config.get('parquet_folder')).resolve()))
+    return (backend, None)
+
+
 class config_file():
     def __init__(self, 
-                 DEFAULT_CONFIG_FILE: str = None
+                 DEFAULT_CONFIG_FILE: str = None,
+                 TOTAL_CONFIG: dict = None
                 ) -> None:
-        
+        """Reads the configuration from the yaml file 'DEFAULT_CONFIG_FILE' or from the dictionary 'TOTAL_CONFIG' 
+        (same keys as the yaml file, e.g. a JSON payload)"""
+        if TOTAL_CONFIG is not None:
+            self.DEFAULT_CONFIG_FILE = None
+            self.TOTAL_CONFIG = self.parse_config(dict(TOTAL_CONFIG))
+            return
         if DEFAULT_CONFIG_FILE is not None:
             self.DEFAULT_CONFIG_FILE = DEFAULT_CONFIG_FILE
         else:
@@ -41,6 +166,13 @@ class config_file():
         """Reads the config yaml file and transforms the indicated geometry in a shapely.geometry"""
         with open(self.DEFAULT_CONFIG_FILE) as src:
             dd = yaml.load(src, yaml.loader.FullLoader)
+        return self.parse_config(dd)
+    
+    def parse_config(self, dd):
+        """Transforms the geometry indicated in the config dictionary in a shapely.geometry ('specific_end_date: today'
+        is replaced by the current date, e.g. for the daily incremental runs)"""
+        if dd.get('specific_end_date') == 'today':
+            dd['specific_end_date'] = f'{dt.date.today():%d-%m-%Y}'
         if isinstance(dd['geometry'], list):
             if not isinstance(dd['geometry'][0], str):
                 dd['geometry'] = self.recompose_polygon_from_coordinates(dd['geometry'], dd['polygon_type'])
@@ -75,14 +207,8 @@ class config_file():
          - geom: Polygon or Multipoligon geometry
          """      
         # GET SHAPEFILE
-        url_to_download    = "https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/ne_110m_admin_0_map_units.zip"#"https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/ne_50m_admin_0_countries.zip"
         #file_path_location = '/home/esowc32/PROJECT/DATA/shapefiles/personalized_from_ne_110m_admin_0_map_units.geojson'
-        file_path_location = None
-        sbcm = subcountrymap(file_path_location = file_path_location, url_to_download = url_to_download)
-        countries  = sbcm.shapefile.copy()
-        countries.index = countries.GEOUNIT
-        all_shapes = pd.concat([countries, sbcm.continent_shapefile.copy()])[['geometry','continent']]
-        all_shapes = all_shapes.groupby(all_shapes.index).last()
+        all_shapes = load_boundaries(file_path_location = None)
         if isinstance(countries_names, list):
             self.countryname = []
             all_geoms = []
@@ -145,7 +271,16 @@ class config_file():
     
     
 class query_data():
-    def __init__(self, TOTAL_CONFIG: dict = None) -> None:
+    def __init__(self, TOTAL_CONFIG: dict = None, extraction_cache: dict = None, run_query: bool = True, db = None, on_exact = None) -> None:
+        self.extraction_cache = extraction_cache
+        self.db = db # reader to use, by default the one of the config 'backend' (see 'create_reader')
+        self.limits = {} # latency budget or sample of the PostGIS queries (see 'create_dataset_query')
+        self.readers = [] # readers used by the queries (see 'cancel')
+        self.cancelled = False
+        self.preview = None # sample and error of the data when it is an approximate preview
+        self.exact = None # thread of the exact query that replaces the preview
+        self.exact_error = None
+        self.on_exact = on_exact # called with this query_data when the exact query of a preview ends
         self.table_database = {
                 'Wildfire flux of Carbon Dioxide'           :('co2fire'  , 'gfas_co2fire_data',  'kg/day',),                   
                 'Wildfire flux of Carbon Monoxide'          :('cofire'   , 'gfas_cofire_data',   'kg/day',),                                                        
@@ -163,7 +298,39 @@ class query_data():
         
         if TOTAL_CONFIG is not None:
             self.TOTAL_CONFIG = TOTAL_CONFIG
-            self.data = self.create_dataset_query()
+            self.variables = self.get_variables()
+            if run_query:
+                self.data = self.create_dataset_query()
+
+    def get_variables(self):
+        """Returns the variable(s) of the config as a list (the config 'variable' can be a single name or a list of names
+        from 'table_database')"""
+        variables = self.TOTAL_CONFIG['variable']
+        if isinstance(variables, str):
+            variables = [variables]
+        for var in variables:
+            if var not in self.table_database:
+                raise ValueError(f"The variable '{var}' contained in the config is not any of {list(self.table_database.keys())}")
+        return list(variables)
+
+    def split_by_variable(self, data):
+        """When more variables are queried together every column of 'data' is prefixed by the variable name
+        ('gfas_co2fire_01/06/2022 - 30/06/2022'). Returns a dictionary {variable: data} where each DataFrame has the
+        same columns that a single variable query would have returned."""
+        if len(self.variables) == 1:
+            return {self.variables[0]: data}
+        data_split = {}
+        for var in self.variables:
+            prefix = f"{self.table_database[var][1].replace('_data','')}_"
+            cols = {c: c.replace(prefix, '') for c in data.columns if c.replace('REFERENCE: ', '').startswith(prefix)}
+            if 'geometry' in data.columns:
+                data_var = data[list(cols.keys())+['geometry']].rename(columns = cols)
+                # cells where only the other variables have points (see 'GfasReaderBase.mask_empty_groups')
+                data_var = data_var.dropna(subset = list(cols.values()), how = 'all')
+            else:
+                data_var = data[list(cols.keys())].rename(columns = cols)
+            data_split[var] = data_var
+        return data_split
 
     def adapt_resolution(self, data_or, resolution = None):
         """Function to resample the data at different resolutions ('daily' or 'monthly' for now)"""
@@ -181,6 +348,159 @@ class query_data():
             datanew = data_or # they are already at a daily resolution
         return datanew
 
+    def get_table_name(self):
+        """Name of the database table of the config variable (list of tables if more variables are requested)"""
+        table_name = [self.table_database[var][1] for var in self.variables]
+        if len(table_name) == 1:
+            table_name = table_name[0]
+        return table_name
+
+    def extraction_key(self, start_date = None, end_date = None, function_to_aggregate = 'sum', keep_separate_dates = False):
+        """Returns a hashable key that identifies the database extraction needed by 'extract_data' with the same arguments.
+        Two configurations that share the key run exactly the same query on the same data source (the 1D queries do not
+        depend on 'keep_separate_dates' and 'memory_lean', the days are averaged afterwards)."""
+        table_name = self.get_table_name()
+        if isinstance(table_name, str):
+            table_name = [table_name]
+        mode = '2D' if '2D' in self.TOTAL_CONFIG['plot_type'] else '1D'
+        return (('source', data_source(self.TOTAL_CONFIG, self.db)),
+                ('table_name', tuple(table_name)),
+                ('geometry', hashlib.sha1(self.TOTAL_CONFIG['geometry'].wkb).hexdigest()),
+                ('start_date', f"{dt.datetime.strptime(start_date,'%d-%m-%Y'):%Y-%m-%d}"),
+                ('end_date', f"{dt.datetime.strptime(end_date,'%d-%m-%Y'):%Y-%m-%d}"),
+                ('operation', function_to_aggregate),
+                ('mode', mode),
+                ('keep_separate_dates', keep_separate_dates if mode == '2D' else None),
+                # string 'x_y' cell ids or integer cell ids
+                ('memory_lean', bool(self.TOTAL_CONFIG.get('memory_lean', False)) if mode == '2D' else None))
+
+    def query_database(self, start_date, end_date, function_to_aggregate = 'sum', keep_separate_dates = False):
+        """Runs the query on the database (dates are datetimes). Returns the data and the first and last date found.
+        For the 2D plots 'function_to_aggregate' can be a list of operations."""
+        table_name = self.get_table_name()
+        db = self.db if self.db is not None else create_reader(self.TOTAL_CONFIG) #starts the connection with the database
+        if self.cancelled:
+            raise QueryCancelled('The query was cancelled.')
+        if isinstance(db, GfasActivityReader): # own copy, so that it can be limited and cancelled (see 'cancel')
+            db = db.with_limits(**self.limits)
+        self.readers.append(db)
+        polygon = self.TOTAL_CONFIG['geometry']
+
+        if '2D' in self.TOTAL_CONFIG['plot_type']: # index are now 'clust' 'x_y' info (integer cell ids in memory-lean mode)
+            lean = self.TOTAL_CONFIG.get('memory_lean', False)
+            agg_operations = function_to_aggregate if isinstance(function_to_aggregate, list) else [function_to_aggregate]
+            chunked = self.TOTAL_CONFIG.get('chunked', False) and all(op in MERGEABLE_OPERATIONS for op in agg_operations)
+            if chunked and ('sample_percent' not in self.limits): # the previews read a small sample in a single process
+                # time windows x spatial tiles aggregated by worker processes, each with its own (limited) reader
+                data_or, data = extract_data_polygon_chunked(functools.partial(create_limited_reader, self.TOTAL_CONFIG, self.limits),
+                                                             table_name, start_date, end_date, polygon,
+                                                             agg_operations = agg_operations, resolution = 0.1,
+                                                             keep_separate_dates = keep_separate_dates, lean = lean,
+                                                             chunk_days = self.TOTAL_CONFIG.get('chunk_days', 92),
+                                                             tile_degrees = self.TOTAL_CONFIG.get('chunk_tile_degrees', 10),
+                                                             max_workers = self.TOTAL_CONFIG.get('chunk_workers', None),
+                                                             is_cancelled = lambda: self.cancelled)
+                if data.empty:
+                    return data, None, None
+                return data, data_or.index[0], data_or.index[-1]
+            if lean:
+                db.start_memory_report()
+            data_or, data = db.extract_data_polygon(table_name, start_date, end_date, polygon,
+                                                    agg_operations = agg_operations,
+                                                    resolution = 0.1, keep_separate_dates = keep_separate_dates,
+                                                    lean = lean)
+            if lean:
+                db.print_memory_report()
+            self.add_preview(data)
+            if data.empty:
+                return data, None, None
+            return data, data_or.index[0], data_or.index[-1]
+        else:
+            data = db.extract_data2(start_date, end_date, polygon, table_name, agg_operation = function_to_aggregate)
+            self.add_preview(data)
+            if data.empty:
+                return data, None, None
+            return data, data.index[0], data.index[-1]
+
+    def add_preview(self, data):
+        """Keeps the sample and the largest relative error of the approximate extractions in 'self.preview'"""
+        preview = data.attrs.pop('preview', None) if data is not None else None
+        if preview is None:
+            return
+        relative_error = preview['relative_error']
+        if self.preview is not None:
+            relative_error = np.fmax(relative_error, self.preview['relative_error'])
+        self.preview = dict(sample_percent = preview['sample_percent'], relative_error = float(relative_error))
+
+    def query_incremental(self, key, start_date, end_date, function_to_aggregate = 'sum', keep_separate_dates = False):
+        """Incremental version of 'query_database' ('incremental: True' in the config), for configs re-run as new days
+        are added to the database. The state of the extraction is stored in 'output_folder/incremental_state' (one file
+        per extraction key without the end date) with its watermark, the last date found: only the days after the
+        watermark are queried and merged into the state.
+        The state is the per-day data, or the per-cell partial aggregates (count, sum, min, max, M2) for the 2D plot of
+        the whole period ('median' cannot be merged, so it is always queried in full). It is keyed on the data source and
+        the 'memory_lean' mode (the cell ids of the lean mode are integers), and rebuilt if the end date is before the
+        watermark or if the file does not contain the same key (e.g. written by an older version)."""
+        plot_2d = '2D' in self.TOTAL_CONFIG['plot_type']
+        partial = plot_2d and not keep_separate_dates
+        if partial and (function_to_aggregate not in MERGEABLE_OPERATIONS):
+            print(f"INCREMENTAL: '{function_to_aggregate}' cannot be merged, the whole period is queried")
+            return self.query_database(start_date, end_date, function_to_aggregate, keep_separate_dates)
+        state_key = dict(key)
+        state_key.pop('end_date')
+        state_key.update(source = data_source(self.TOTAL_CONFIG, self.db),
+                         memory_lean = bool(self.TOTAL_CONFIG.get('memory_lean', False)) if plot_2d else None)
+        state_key = tuple(sorted(state_key.items()))
+        path = Path(self.TOTAL_CONFIG.get('output_folder', Path.cwd())) / 'incremental_state' / f'{ResultCache.hash_key(state_key)}.pkl'
+
+        state = None
+        if path.exists():
+            try:
+                with open(path, 'rb') as src:
+                    state = pickle.load(src)
+            except Exception as err: # e.g. truncated by a run killed with an older version, rebuilt
+                print(f'INCREMENTAL: unreadable state {path.name} ({type(err).__name__}), the whole period is queried')
+            if (state is not None) and ((state.get('key') != state_key) or (state['watermark'] > end_date)):
+                state = None
+        query_start = start_date if state is None else state['watermark'] + dt.timedelta(days = 1)
+        if query_start <= end_date:
+            if partial:
+                new, first, last = self.query_database(query_start, end_date, list(PARTIAL_OPERATIONS), keep_separate_dates)
+                new = to_partial(new) if not new.empty else new
+            else:
+                new, first, last = self.query_database(query_start, end_date, function_to_aggregate, keep_separate_dates)
+            print(f'INCREMENTAL: queried {query_start:%d-%m-%Y} to {end_date:%d-%m-%Y}, last date found: {last}')
+        else:
+            new, first, last = pd.DataFrame(), None, None
+
+        if state is None:
+            state = dict(key = state_key, data = new, first = first, last = last, watermark = start_date - dt.timedelta(days = 1))
+        elif not new.empty:
+            if state['data'].empty:
+                state['data'] = new
+            elif partial:
+                state['data'] = merge_partials(state['data'], new)
+            else:
+                state['data'] = pd.concat([state['data'], new]).sort_index()
+            state['first'] = state['first'] if state['first'] is not None else first
+            state['last'] = last
+        if state['last'] is not None:
+            state['watermark'] = state['last']
+        path.parent.mkdir(exist_ok = True, parents = True)
+        # written aside then renamed: a run killed while writing leaves the previous state intact
+        tmp = path.with_name(f'{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with open(tmp, 'wb') as dst:
+                pickle.dump(state, dst, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok = True)
+
+        data = state['data']
+        if partial and not data.empty:
+            data = finalize(data, function_to_aggregate)
+        return data, state['first'], state['last']
+
     def extract_data(self, adapt_resolution_option = True, 
                  start_date = None, 
                  end_date = None, 
@@ -188,90 +508,186 @@ class query_data():
                  keep_separate_dates = False,
                  reference_period = False):
 
-        table_name = self.table_database[self.TOTAL_CONFIG['variable']][1]
-        db = GfasActivityReader() #starts the connection with the database
-        polygon = self.TOTAL_CONFIG['geometry']
-        minx, miny,maxx, maxy = polygon.bounds
+        table_name = self.get_table_name()
+        key = self.extraction_key(start_date, end_date, function_to_aggregate, keep_separate_dates)
         start_date = dt.datetime.strptime(start_date,'%d-%m-%Y')
         end_date   = dt.datetime.strptime(end_date,'%d-%m-%Y')
         if start_date>end_date:
             raise ValueError(f'INVALID SPECIFIC PERIOD: start after end. Start={start_date:%d-%m-%Y}, End={end_date:%d-%m-%Y}')
 
-        if '2D' in self.TOTAL_CONFIG['plot_type']: # index are now 'clust' 'x_y' info
-            data_or, data = db.extract_data_polygon(table_name, start_date, end_date, polygon,
-                                                    agg_operations = [function_to_aggregate],
-                                                    resolution = 0.1, keep_separate_dates = keep_separate_dates)
-            if data.empty:
-                return data
+        # the same extraction can be shared between different configurations (see 'batch_runner' and 'ResultCache')
+        cached = self.extraction_cache.get(key) if self.extraction_cache is not None else None
+        sampled = 'sample_percent' in self.limits # the previews are never cached
+        if cached is not None:
+            data, start_date, end_date = cached
+        else:
+            if self.TOTAL_CONFIG.get('incremental', False) and not sampled:
+                data, start_date, end_date = self.query_incremental(key, start_date, end_date, function_to_aggregate, keep_separate_dates)
+            else:
+                data, start_date, end_date = self.query_database(start_date, end_date, function_to_aggregate, keep_separate_dates)
+            if (self.extraction_cache is not None) and not sampled:
+                self.extraction_cache[key] = (data, start_date, end_date)
+        if data.empty:
+            return data
+        data = data.copy()
+
+        if '2D' in self.TOTAL_CONFIG['plot_type']:
             adapt_resolution_option = False
-            start_date, end_date   = data_or.index[0], data_or.index[-1]
         else:
-            data = db.extract_data2(start_date, end_date, polygon, table_name, agg_operation = function_to_aggregate)
-            if data.empty:
-                return data
-            start_date, end_date   = data.index[0], data.index[-1]
-            months_abbreviations = {'January':'Jan', 'February': 'Feb', 'March': 'Mar', 'April': 'Apr', 'May':   'May', 'June':  'Jun', 'July' : 'Jul', 'August':'Aug', 'September': 'Sept', 'October'  : 'Oct', 'November' : 'Nov', 'December' : 'Dec'}
             # AVERAGE SAME DAY OF DIFFERENT YEAR TOGETHER
             if not keep_separate_dates:
                 data = data.groupby([f'{dd:02d}-{mm:02d}' for dd, mm in zip(data.index.day, data.index.month)]).mean()
                 data.index = [pd.Timestamp(year = 2220, day = int(f[0:2]), month = int(f[3::])) for f in data.index]
                 data.index = pd.DatetimeIndex(data.index)
-        data.columns = [f"{start_date.day:02d}/{start_date.month:02d}/{start_date.year} - {end_date.day:02d}/{end_date.month:02d}/{end_date.year}" if (f!='geometry') else 'geometry' for f in data.columns]
+        period = f"{start_date.day:02d}/{start_date.month:02d}/{start_date.year} - {end_date.day:02d}/{end_date.month:02d}/{end_date.year}"
+        if isinstance(table_name, str):
+            data.columns = [period if (f!='geometry') else 'geometry' for f in data.columns]
+        else: # one column per variable, the variable name is kept as prefix (2D columns are like 'gfas_co2fire_sum')
+            var_names = [tab.replace('_data','') for tab in table_name]
+            data.columns = [f'{[var for var in var_names if (f==var) | f.startswith(f"{var}_")][0]}_{period}' if (f!='geometry') else 'geometry' for f in data.columns]
 
         if adapt_resolution_option:
             return self.adapt_resolution(data.copy(), resolution = self.TOTAL_CONFIG['resolution'])
         else:
             return data.copy()
+
+    def extraction_requests(self):
+        """Returns the list of 'extract_data' calls (as dictionaries of arguments) needed by the plot in the config:
+        the specific period first and, for 'Line Plot' and 'Bar Plot', the reference period."""
+        aggregating_operation = self.TOTAL_CONFIG['aggregating_operation']
+        if (self.TOTAL_CONFIG['plot_type'] =='2D Animated Plot'):
+            return [dict(start_date = self.TOTAL_CONFIG['specific_start_date'], 
+                         end_date = self.TOTAL_CONFIG['specific_end_date'], 
+                         function_to_aggregate = aggregating_operation,
+                         keep_separate_dates = True, 
+                         reference_period = False)]
+        if self.TOTAL_CONFIG['plot_type'] =='Line Plot':
+            keep_separate_dates = True
+        else:
+            keep_separate_dates = False
+        requests = [dict(start_date = self.TOTAL_CONFIG['specific_start_date'],
+                         end_date = self.TOTAL_CONFIG['specific_end_date'],
+                         function_to_aggregate = aggregating_operation,
+                         keep_separate_dates = keep_separate_dates)]
+        if (self.TOTAL_CONFIG['reference_start_date']!='') & (self.TOTAL_CONFIG['reference_end_date']!='') & (self.TOTAL_CONFIG['plot_type'] !='2D Plot'):
+            requests.append(dict(start_date = self.TOTAL_CONFIG['reference_start_date'],
+                                 end_date = self.TOTAL_CONFIG['reference_end_date'],
+                                 reference_period = True,
+                                 function_to_aggregate = aggregating_operation,
+                                 keep_separate_dates = keep_separate_dates))
+        return requests
             
     def create_dataset_query(self):
         """Main functions that decides how to query the data from the Database depending on the plot needed.
         '2D Animated Plot' and 'Line Plot'
             query a DataFrame that contains every da of the specific reference period 
         
-        
+        With a latency budget ('deadline' in seconds in the config, PostGIS backend) the whole request must answer within
+        'deadline' seconds: the exact queries share the budget minus 'preview_budget' seconds (default a quarter of it),
+        reserved for the preview. If the server stops them, an approximate preview is returned instead: the same queries
+        on a SYSTEM sample of 'preview_sample_percent' % (default 1) of the disk blocks, scaled to the whole data and
+        limited to the rest of the budget, with the sample and the relative standard error of the total in
+        'self.preview'. The exact queries then run in a background thread ('self.exact', see 'wait_exact') and replace
+        'self.data' when done. The queries can be stopped with 'cancel'.
         """
-        aggregating_operation = self.TOTAL_CONFIG['aggregating_operation']
-        var = self.table_database[self.TOTAL_CONFIG['variable']][1] 
+        deadline = self.TOTAL_CONFIG.get('deadline', None)
+        if deadline is None:
+            return self.query_requests()
+        if not isinstance(self.db, GfasActivityReader) and (self.TOTAL_CONFIG.get('backend', 'postgis') != 'postgis'):
+            print("DEADLINE: only available for the 'postgis' backend, the queries are not limited")
+            return self.query_requests()
+        start = time.monotonic()
+        preview_budget = self.TOTAL_CONFIG.get('preview_budget', deadline/4)
+        self.limits = dict(budget_end = start + deadline - preview_budget)
+        try:
+            return self.query_requests()
+        except TimeoutError:
+            sample_percent = self.TOTAL_CONFIG.get('preview_sample_percent', 1)
+            print(f'DEADLINE: the exact queries took more than {deadline - preview_budget:g} s, preview on a {sample_percent}% sample of the data')
+            self.limits = dict(sample_percent = sample_percent, budget_end = start + deadline)
+            try:
+                data = self.query_requests()
+            except TimeoutError as err:
+                raise TimeoutError(f'Neither the exact queries nor the preview on a {sample_percent}% sample answered within '
+                                   f'the deadline of {deadline} s (lower preview_sample_percent or raise deadline).') from err
+        finally:
+            self.limits = {}
+        if self.preview is not None:
+            print(f"DEADLINE: preview relative error of the total {self.preview['relative_error']:.2%}, the exact query continues in the background")
+        self.exact = threading.Thread(target = self.run_exact, daemon = True)
+        self.exact.start()
+        return data
+
+    def run_exact(self):
+        """Runs the exact queries after a preview (background thread) and replaces 'self.data' and 'self.preview' (kept
+        if the query fails or is cancelled). 'self.on_exact' is called at the end in any case."""
+        try:
+            self.data, self.preview = self.query_requests(), None
+            print('DEADLINE: the exact data replaced the preview')
+        except QueryCancelled:
+            print('DEADLINE: the exact query was cancelled, the preview is kept')
+        except Exception as err:
+            self.exact_error = err
+        finally:
+            if self.on_exact is not None:
+                self.on_exact(self)
 
+    def wait_exact(self, timeout = None):
+        """Waits for the exact data that replaces the preview (if any) and returns 'self.data'. Ctrl-C cancels it."""
+        if self.exact is not None:
+            try:
+                self.exact.join(timeout)
+            except KeyboardInterrupt:
+                self.cancel()
+                self.exact.join()
+                raise
+            if self.exact_error is not None:
+                raise self.exact_error
+        return self.data
+
+    def is_running(self):
+        """True while the exact query of a preview runs in the background"""
+        return (self.exact is not None) and self.exact.is_alive()
+
+    def cancel(self):
+        """Cancels the running queries (and the exact query of a preview) on the server, e.g. from the GUI"""
+        self.cancelled = True
+        for db in list(self.readers):
+            if hasattr(db, 'cancel'):
+                db.cancel()
+
+    def query_requests(self):
+        """Runs the extractions of 'extraction_requests' and merges the specific and reference periods"""
+        requests = self.extraction_requests()
+        data_to_plot = self.extract_data(**requests[0])
         if (self.TOTAL_CONFIG['plot_type'] =='2D Animated Plot'):
-            data_to_plot = self.extract_data(start_date = self.TOTAL_CONFIG['specific_start_date'], 
-                                        end_date = self.TOTAL_CONFIG['specific_end_date'], 
-                                        function_to_aggregate = aggregating_operation,
-                                        keep_separate_dates = True, 
-                                        reference_period = False)
-        else:
-            if self.TOTAL_CONFIG['plot_type'] =='Line Plot':
-                keep_separate_dates = True
-            else:
-                keep_separate_dates = False
-                
-            data_to_plot = self.extract_data(start_date = self.TOTAL_CONFIG['specific_start_date'],
-                                        end_date = self.TOTAL_CONFIG['specific_end_date'],
-                                        function_to_aggregate = aggregating_operation,
-                                        keep_separate_dates = keep_separate_dates)
-            #ADD reference period
-            if (self.TOTAL_CONFIG['reference_start_date']!='') & (self.TOTAL_CONFIG['reference_end_date']!='') & (self.TOTAL_CONFIG['plot_type'] !='2D Plot'):
-                reference_data = self.extract_data(start_date = self.TOTAL_CONFIG['reference_start_date'],
-                                              end_date = self.TOTAL_CONFIG['reference_end_date'],
-                                              reference_period = True,
-                                              function_to_aggregate = aggregating_operation,
-                                              keep_separate_dates = keep_separate_dates
-                                             )
-                reference_data.rename(columns={c: f'REFERENCE: {c}' for c in reference_data.columns}, inplace=True)
-                data_to_plot   = pd.merge( reference_data, data_to_plot, left_index=True, right_index=True, how = 'outer')
-            data_to_plot   = data_to_plot.sort_index()
+            return data_to_plot
+        #ADD reference period
+        if len(requests) > 1:
+            reference_data = self.extract_data(**requests[1])
+            reference_data.rename(columns={c: f'REFERENCE: {c}' for c in reference_data.columns}, inplace=True)
+            data_to_plot   = pd.merge( reference_data, data_to_plot, left_index=True, right_index=True, how = 'outer')
+        data_to_plot   = data_to_plot.sort_index()
         return data_to_plot
     
 
 class plot_data():
+    save_dpi = 300 # resolution of the saved plots (the basemap is simplified to it)
+
     def __init__(self, 
              TOTAL_CONFIG: str = None,
              data_to_plot: pd.DataFrame = None,
              table_database: dict = None,
+             display_animation: bool = True,
+             sketch: QuantileSketch = None,
+             preview: dict = None,
             ) -> None:    
         self.TOTAL_CONFIG   = TOTAL_CONFIG
         self.table_database = table_database
         self.data_to_plot   = data_to_plot
+        self.display_animation = display_animation # show the animation in the notebook (html5 video)
+        self.sketch = sketch # quantiles of the 2D values, can be shared (merged) by more regions (see 'color_bins')
+        self.preview = preview # approximate data (see 'query_data.preview'), marked on the plot
         
         self.fig_sol, self.ax_sol = plt.subplots(figsize=(8, 5.3), dpi=1080/8, # constrained_layout=True,
                                                 gridspec_kw = dict(width_ratios = [1], height_ratios = [1])) #figsize = (8,5),
@@ -321,21 +737,11 @@ class plot_data():
         return ax
 
     def plot2dbackground(self, ax):
-        """Function to create the background of the 2d plot, with boarders of the countries and the highlighted area of interest."""
+        """Function to create the background of the 2d plot, with boarders of the countries and the highlighted area of interest.
+        Only the boundaries inside the view are drawn, simplified to the output resolution (see 'basemap_segments')."""
         bb = self.TOTAL_CONFIG['geometry']
         elem = gpd.GeoDataFrame(geometry = [bb], crs = 'EPSG:4326')
         ax = elem.boundary.plot(ax=ax, zorder = 0, color = 'grey', alpha = 1, lw = 0.7)
-        
-        # GET SHAPEFILE
-        url_to_download    = "https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/ne_110m_admin_0_map_units.zip"#"https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/ne_50m_admin_0_countries.zip"
-        file_path_location = '/home/esowc32/PROJECT/DATA/shapefiles/personalized_from_ne_110m_admin_0_map_units.geojson'
-        sbcm = subcountrymap(file_path_location = file_path_location, url_to_download = url_to_download)
-        countries  = sbcm.shapefile.copy()
-        countries.index = countries.GEOUNIT
-        all_shapes = pd.concat([countries, sbcm.continent_shapefile.copy()])[['geometry','continent']]
-        all_shapes = all_shapes.groupby(all_shapes.index).last()
-        
-        ax = all_shapes.boundary.plot(ax=ax, color = 'grey', alpha =0.8, lw = 0.2)
 
         #extract limits
         ll = max(bb.bounds[2]-bb.bounds[0], bb.bounds[3]-bb.bounds[1])
@@ -343,11 +749,40 @@ class plot_data():
 #         bbnew = box(bb.centroid.x-ll/2,bb.centroid.y-ll/2,bb.centroid.x+ll/2,bb.centroid.y+ll/2)
         bbnew = box(bb.bounds[0], bb.bounds[1], bb.bounds[2], bb.bounds[3])
         xmin,ymin,xmax, ymax = bbnew.buffer(2).bounds
+
+        # GET SHAPEFILE
+        file_path_location = '/home/esowc32/PROJECT/DATA/shapefiles/personalized_from_ne_110m_admin_0_map_units.geojson'
+        extent = tuple(float(f) for f in np.round([xmin, ymin, xmax, ymax], 6))
+        segments = basemap_segments(extent, dpi = self.save_dpi, width_inches = ax.get_figure().get_figwidth(),
+                                    file_path_location = file_path_location)
+        ax.add_collection(LineCollection(segments, colors = 'grey', alpha = 0.8, linewidths = 0.2), autolim = False)
+
         ## set limits new
         ax.set_xlim(xmin,xmax)
         ax.set_ylim(ymin,ymax)
         return ax
 
+    def color_bins(self, data = None, k = 10):
+        """Quantile color bins (k classes) of the 2D values, used by the plots, the animation frames and the tiles.
+        The bins of 'self.data_to_plot' come from a QuantileSketch updated one day at a time and computed only once
+        (or from the 'sketch' given to the constructor)."""
+        if (data is not None) and (data is not self.data_to_plot):
+            return QuantileSketch.from_values(data.iloc[:,0].values).bins(k)
+        if self.sketch is None:
+            self.sketch = self.update_sketch(QuantileSketch(), self.data_to_plot)
+        return self.sketch.bins(k)
+
+    @staticmethod
+    def update_sketch(sketch, data):
+        """Adds to 'sketch' the 2D values of 'data' (first column), one day at a time. Returns the sketch."""
+        values = data.iloc[:,0]
+        if isinstance(values.index, pd.MultiIndex):
+            for _, day_values in values.groupby(level = 0):
+                sketch.update(day_values.values)
+        else:
+            sketch.update(values.values)
+        return sketch
+
     def plot_2dplot(self, data, ax, operation = 'sum', title = None, background = False, vmin=None, vmax=None, scheme='quantiles', classification_kwds=None):
         """Creates the 2D plot using the datas in 'self.data_to_plot' """
 
@@ -364,6 +799,8 @@ class plot_data():
 
         if background:
             ax = self.plot2dbackground(ax)
+        if (scheme == 'quantiles') and (classification_kwds is None): # approximate quantiles, no sort of all the values
+            scheme, classification_kwds = 'User_Defined', dict(bins = self.color_bins(data))
             
         data.plot(column_name_to_plot,
                      ax=ax, 
@@ -388,7 +825,7 @@ class plot_data():
         scheme="User_Defined"
         val_min = all_days.iloc[:,0].min()
         val_max = all_days.iloc[:,0].max()
-        classification_kwds=dict(bins=mc.Quantiles(all_days.iloc[:,0]).bins)
+        classification_kwds=dict(bins=self.color_bins(all_days))
 
         indd = []
         for days in all_days.index.get_level_values(0).drop_duplicates():
@@ -428,15 +865,47 @@ class plot_data():
             return ax_sol
         plt.close()
         anim = FuncAnimation(fig_sol, animate, frames=len(indd), interval=250)
-        video = anim.to_html5_video()
-        html = ipydisplay.HTML(video)
-        ipydisplay.display(html, clear= True )
+        if self.display_animation:
+            video = anim.to_html5_video()
+            html = ipydisplay.HTML(video)
+            ipydisplay.display(html, clear= True )
         return anim
 
+    def create_tile_layers(self, tile_server, cache_folder = None, label = None):
+        """Creates the ipyleaflet tile layers of the 2D data (see 'TileGenerator'), served by 'tile_server'.
+        Returns a list with one layer (one per day for the '2D Animated Plot', all with the same color bins).
+        The cached tiles are found by label ('cache_folder/label'), so the label always ends with a digest of the
+        period, the operation, the color bins and the values: a new extraction never gets the tiles of an older one."""
+        config = self.TOTAL_CONFIG
+        data = self.data_to_plot
+        multi_day = isinstance(data.index, pd.MultiIndex)
+        bins = self.color_bins(k = 10)
+        digest = hashlib.sha1()
+        digest.update(f"{config['specific_start_date']}{config['specific_end_date']}{config['aggregating_operation']}".encode())
+        digest.update(np.asarray(bins, dtype = np.float64).tobytes())
+        digest.update(pd.util.hash_pandas_object(data.drop(columns = 'geometry', errors = 'ignore'), index = True).values.tobytes())
+        if label is None:
+            label = hashlib.sha1(f"{config['variable']}{config['geometry'].wkt}".encode()).hexdigest()[:12]
+        label = f'{label}_{digest.hexdigest()[:12]}'
+        if multi_day:
+            days = data.index.get_level_values(0).drop_duplicates()
+            generators = [TileGenerator(data, cache_folder = cache_folder, label = f'{label}_{day:%Y%m%d}', date = day, bins = bins)
+                          for day in days]
+        else:
+            generators = [TileGenerator(data, cache_folder = cache_folder, label = label, bins = bins)]
+        layers = []
+        for generator in generators:
+            tile_server.add(generator)
+            layers.append(tile_server.tile_layer(generator.label))
+        return layers
+
     def create_plot_type(self, countryname):
         config = self.TOTAL_CONFIG
         plot_type = config['plot_type']
         """Creates the plot"""
+        if self.preview is not None:
+            self.fig_sol.text(0.99, 0.01, f"PREVIEW: {self.preview['sample_percent']:g}% sample, relative error of the total {self.preview['relative_error']:.1%}",
+                              ha = 'right', va = 'bottom', color = 'red', fontsize = 8)
         if plot_type == 'Line Plot':
             self.ax_sol = self.plot_lineplot(self.data_to_plot, self.ax_sol)
             self.outfilename = f"LinePlot_{countryname}_from{config['specific_start_date']}to{config['specific_end_date']}.png"
@@ -462,7 +931,7 @@ class plot_data():
             self.anim.save(outfilepath)
         else:
             self.fig_sol.tight_layout()
-            self.fig_sol.savefig(outfilepath, dpi = 300, facecolor = 'w')
+            self.fig_sol.savefig(outfilepath, dpi = self.save_dpi, facecolor = 'w')
             
     def save_csv(self):
         plot_type = self.TOTAL_CONFIG['plot_type']
@@ -472,33 +941,225 @@ class plot_data():
             data_to_save.index = [f"{dd.day:02d}-{dd.strftime('%b')}" for dd in data_to_save.index]
         data_to_save.to_csv(outfilepath)
 
-def main():
-    configfile = sys.argv[1]
-    cf = config_file(configfile) #('/home/esowc32/PROJECT/DATA/test_config.yml')
-    config = cf.TOTAL_CONFIG
-    # CHECK OUTPUT FOLDER
+def prepare_output_folder(config):
+    """Creates the output folder of the config (a new folder in the current directory if none is specified)"""
     if not 'output_folder' in config.keys(): # if no path specified a new fodler is created in the current directory
         config['output_folder'] = Path.cwd() / f"outfolder_query_{dt.datetime.now().strftime(format='%d%m%YT%H%M%S')}"
     Path(config['output_folder']).mkdir(exist_ok= True, parents = True)
-    
-    if 'add_csv_results' in config.keys():
-        save_csv = config['add_csv_results']  
-        #config.pop('add_csv_results')
-    
-    for geom, cname in zip(config['geometry'], cf.countryname):
-        print(cname)
+    return config
+
+
+def run_geometries(config, geometries, cnames, extraction_cache = None):
+    """Queries, plots and saves the results of the geometries of the config. All the geometries are queried first, so
+    that their 2D plots share the same color bins (one QuantileSketch per variable, see 'shared_sketches')."""
+    save_csv = config.get('add_csv_results', False)
+    jobs = []
+    for geom, cname in zip(geometries, cnames):
+        print(f'query {cname}')
         config2 = config.copy()
         config2.update({'geometry':geom})
-        print('query')
-        qd = query_data(config2)
-        table_database = qd.table_database
-        data = qd.data
-        print('plot')
-        plod = plot_data(config2, data, table_database)
-        plod.create_plot_type(cname)
+        jobs.append((query_data(config2, extraction_cache = extraction_cache), config2, cname))
+    sketches = shared_sketches([qd for qd, _, _ in jobs])
+    for qd, config2, cname in jobs:
+        plot_geometry(qd, config2, cname, save_csv, sketches = sketches)
+    previews = [qd for qd, _, _ in jobs if qd.preview is not None]
+    if previews: # the preview files are overwritten by the exact ones
+        print('waiting for the exact queries (Ctrl-C cancels them, the preview files are kept)')
+        for qd in previews:
+            qd.wait_exact()
+        if any(qd.preview is None for qd in previews): # new bins for all the geometries
+            sketches = shared_sketches([qd for qd, _, _ in jobs])
+            for qd, config2, cname in jobs:
+                plot_geometry(qd, config2, cname, save_csv, sketches = sketches)
+
+
+def run_geometry(config, geom, cname, extraction_cache = None):
+    """Queries, plots and saves the results of a single geometry of the config."""
+    run_geometries(config, [geom], [cname], extraction_cache = extraction_cache)
+
+
+def shared_sketches(queries):
+    """Returns {variable: QuantileSketch} of the 2D values of all the query_data in 'queries' (e.g. the regions of a
+    config), to be shared by their plots: the same values get the same color in every region. Empty for the 1D plots."""
+    sketches = {}
+    for qd in queries:
+        if '2D' not in qd.TOTAL_CONFIG['plot_type']:
+            continue
+        for var, data in qd.split_by_variable(qd.data).items():
+            if not data.empty:
+                plot_data.update_sketch(sketches.setdefault(var, QuantileSketch()), data)
+    return sketches
+
+
+def plot_geometry(qd, config2, cname, save_csv = False, sketches = None):
+    """Plots and saves the data of a query_data (one plot per variable). 'sketches' ({variable: QuantileSketch}, see
+    'shared_sketches') gives the color bins of the 2D plots."""
+    table_database = qd.table_database
+    # all the variables are queried together, then plotted separately
+    for var, data in qd.split_by_variable(qd.data).items():
+        print(f'plot {var}')
+        config_var = config2.copy()
+        config_var.update({'variable':var})
+        plod = plot_data(config_var, data, table_database, preview = qd.preview, sketch = (sketches or {}).get(var))
+        if len(qd.variables) > 1:
+            plod.create_plot_type(f"{cname}_{table_database[var][0]}")
+        else:
+            plod.create_plot_type(cname)
         plod.save_plot()
         if save_csv:
-            plod.save_csv()   
+            plod.save_csv()
+        plt.close(plod.fig_sol)
+
+
+class batch_runner():
+    def __init__(self, 
+                 config_files: list = None,
+                 result_cache: ResultCache = None
+                ) -> None:
+        """Runs many configuration files together: all the database extractions needed by the configs are planned first,
+        the duplicated ones (same table, geometry, period and operation) are removed and every unique query is executed
+        only once. The results are then shared by the plots and csv of every config. If a 'result_cache' is given the
+        extractions already stored there (e.g. from a previous run) are not executed again."""
+        if not config_files:
+            raise ValueError("No configuration files to run in the batch.")
+        self.config_files = [Path(f) for f in config_files]
+        self.extraction_cache = {}
+        self.result_cache = result_cache
+        
+    @staticmethod
+    def read_config_list(path):
+        """Returns the configuration files contained in a directory (every *.yml/*.yaml file) or listed in a manifest. 
+        The manifest can be a text file with one path per line or a yaml file with a list of paths (or a 'configs' key);
+        relative paths are relative to the manifest folder."""
+        path = Path(path)
+        if path.is_dir():
+            return sorted([f for f in path.iterdir() if f.suffix in ['.yml', '.yaml']])
+        if path.suffix in ['.yml', '.yaml']:
+            with open(path) as src:
+                files = yaml.load(src, yaml.loader.FullLoader)
+            if isinstance(files, dict):
+                files = files['configs']
+        else:
+            with open(path) as src:
+                files = [f.strip() for f in src.readlines() if f.strip() and not f.strip().startswith('#')]
+        return [Path(f) if Path(f).is_absolute() else path.parent / f for f in files]
+    
+    def plan(self):
+        """Reads every config and lists the geometries to plot (jobs) and the extractions needed by each of them.
+        Returns the number of extractions requested and the unique extractions (key: planner query_data, arguments)."""
+        self.jobs = []
+        self.unique_extractions = {}
+        self.key_usage = {}
+        n_requested = 0
+        for configfile in self.config_files:
+            cf = config_file(str(configfile))
+            config = prepare_output_folder(cf.TOTAL_CONFIG)
+            for geom, cname in zip(config['geometry'], cf.countryname):
+                config2 = config.copy()
+                config2.update({'geometry':geom})
+                planner = query_data(config2, extraction_cache = self.extraction_cache, run_query = False)
+                keys = []
+                for request in planner.extraction_requests():
+                    key = planner.extraction_key(request['start_date'], request['end_date'],
+                                                 request['function_to_aggregate'], request['keep_separate_dates'])
+                    keys.append(key)
+                    self.unique_extractions.setdefault(key, (planner, request))
+                    self.key_usage[key] = self.key_usage.get(key, 0) + 1
+                    n_requested += 1
+                self.jobs.append((configfile, config, geom, cname, keys))
+        self.n_requested = n_requested
+        self.executed = set()
+        self.n_from_cache = 0
+        return self.n_requested, self.unique_extractions
+    
+    def execute(self, keys = None):
+        """Executes the given unique extractions (all of them by default) that were not executed yet, once each (the
+        results are kept in 'self.extraction_cache' until their last job is plotted, see 'fan_out')"""
+        keys = list(self.unique_extractions) if keys is None else keys
+        for key in dict.fromkeys(keys): # ordered, without duplicates
+            if key in self.executed:
+                continue
+            self.executed.add(key)
+            planner, request = self.unique_extractions[key]
+            print(f'query {len(self.executed)}/{len(self.unique_extractions)}: {dict(key)}')
+            if self.result_cache is not None:
+                cached = self.result_cache.get(key)
+                if cached is not None:
+                    self.extraction_cache[key] = cached
+                    self.n_from_cache += 1
+                    continue
+            planner.extract_data(**request)
+            if self.result_cache is not None:
+                self.result_cache[key] = self.extraction_cache[key]
+    
+    def fan_out(self):
+        """Creates the plots (and csv) of every job, the geometries of a config together (same color bins, see
+        'run_geometries'). The extractions of a config are executed just before it is plotted (the ones shared with
+        previous configs are already there) and a result is dropped from memory as soon as the last job that needs it
+        has been plotted, so only the results still needed by the remaining configs are held at once."""
+        for configfile, jobs in itertools.groupby(self.jobs, key = lambda job: job[0]):
+            jobs = list(jobs)
+            keys = [key for _, _, _, _, job_keys in jobs for key in job_keys]
+            self.execute(keys)
+            print(f"{configfile.name}: {', '.join([cname for _, _, _, cname, _ in jobs])}")
+            run_geometries(jobs[0][1], [geom for _, _, geom, _, _ in jobs], [cname for _, _, _, cname, _ in jobs],
+                           extraction_cache = self.extraction_cache)
+            for key in keys:
+                self.key_usage[key] -= 1
+                if self.key_usage[key] == 0:
+                    self.extraction_cache.pop(key, None)
+    
+    def run(self):
+        self.plan()
+        self.fan_out()
+        n_unique = len(self.unique_extractions)
+        print(f"""BATCH SUMMARY: {len(self.config_files)} configs, {len(self.jobs)} plots, {self.n_requested} queries requested,
+        {n_unique} unique queries ({self.n_from_cache} read from the cache), {self.n_requested-n_unique} queries saved.""")
+        if self.result_cache is not None:
+            print(self.result_cache.summary())
+        return self.n_requested - n_unique
+
+
+def main():
+    configfile = sys.argv[1]
+    cf = config_file(configfile) #('/home/esowc32/PROJECT/DATA/test_config.yml')
+    config = cf.TOTAL_CONFIG
+    # CHECK OUTPUT FOLDER
+    config = prepare_output_folder(config)
+    result_cache = ResultCache.from_config(config)
+    interruptible_queries() # Ctrl-C cancels the running query on the database server
+    
+    try:
+        run_geometries(config, config['geometry'], cf.countryname, extraction_cache = result_cache)
+    except (QueryCancelled, KeyboardInterrupt):
+        print('QUERY CANCELLED')
+        sys.exit(1)
+    print(result_cache.summary())
+    if config.get('diagnostics', False):
+        print(get_diagnostics(config).summary())
+
+
+def main_batch():
+    """Runs all the configs in a directory or listed in a manifest file (see 'batch_runner.read_config_list').
+    The cache options ('cache_folder', ...) are read from the first config."""
+    parser = argparse.ArgumentParser(description = 'Runs many configuration files together, every shared database extraction once')
+    parser.add_argument('configs', help = 'directory of *.yml config files, or manifest (text or yaml) listing them')
+    args = parser.parse_args()
+    if not Path(args.configs).exists():
+        parser.error(f'{args.configs} does not exist')
+    config_files = batch_runner.read_config_list(args.configs)
+    if not config_files:
+        parser.error(f'no configuration files found in {args.configs}')
+    missing = [str(f) for f in config_files if not Path(f).is_file()]
+    if missing:
+        parser.error(f"configuration files not found: {', '.join(missing)}")
+    result_cache = ResultCache.from_config(config_file(str(config_files[0])).TOTAL_CONFIG)
+    interruptible_queries() # Ctrl-C cancels the running query on the database server
+    try:
+        batch_runner(config_files, result_cache = result_cache).run()
+    except (QueryCancelled, KeyboardInterrupt):
+        print('QUERY CANCELLED')
+        sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -34,6 +34,7 @@ install_requires = [
     "sqlalchemy",
     "ipyleaflet"
 ]
+extras_require = {"parquet": ["duckdb", "pyarrow"], "memory": ["psutil"]}
 tests_require = ["pytest"]
 
 meta = {}
@@ -55,6 +56,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     include_package_data=True,
     install_requires=install_requires,
+    extras_require=extras_require,
     zip_safe=True,
     classifiers=[
         "Intended Audience :: Developers",
@@ -70,7 +72,13 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
 	entry_points={
-        'console_scripts': ['wildfire_explorer=emission_explorer.data_handler:main']
+        'console_scripts': ['wildfire_explorer=emission_explorer.data_handler:main',
+                            'wildfire_explorer_batch=emission_explorer.data_handler:main_batch',
+                            'wildfire_explorer_service=emission_explorer.QueryService:main',
+                            'wildfire_explorer_build_cube=emission_explorer.GfasCubeReader:main',
+                            'wildfire_explorer_export_parquet=emission_explorer.GfasParquetReader:main',
+                            'wildfire_explorer_index_advisor=emission_explorer.QueryDiagnostics:main',
+                            'wildfire_explorer_anomalies=emission_explorer.AnomalyRanking:main']
     },
     tests_require=tests_require,
     test_suite="tests",
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Polygon
+
+pytest.importorskip('duckdb')
+
+from emission_explorer.GfasActivityReader import GfasActivityReader
+from emission_explorer.GfasCubeReader import GfasCubeReader
+from emission_explorer.GfasParquetReader import GfasParquetReader
+
+TABLE = 'gfas_frpfire_data'
+# triangle: the cells of its bounding box outside of it are not selected
+POLYGON = Polygon([(10.0, 40.0), (12.0, 40.0), (10.0, 42.0)])
+
+
+class StubReader(GfasActivityReader):
+    """Database of random fires on the cell centers of the 0.1 deg grid around the polygon, across two years"""
+
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        dates = pd.date_range('2021-12-20', '2022-01-10')
+        cols = rng.integers(1880, 1930, (len(dates), 200))
+        rows = rng.integers(1290, 1330, (len(dates), 200))
+        points = pd.DataFrame({'datetime': np.repeat(dates.values, 200),
+                               'lon': GfasCubeReader.lon0 + (cols.ravel() + 0.5)*GfasCubeReader.res,
+                               'lat': GfasCubeReader.lat0 + (rows.ravel() + 0.5)*GfasCubeReader.res,
+                               # float32 values: stored exactly in the cubes
+                               'value': rng.gamma(0.5, 20, cols.size).astype(np.float32).astype(np.float64)})
+        self.points = points.drop_duplicates(['datetime', 'lon', 'lat'])
+        self.queries = 0
+
+    def query(self, query, params):
+        self.queries += 1
+        selected = self.points[(self.points.datetime >= params['start_date']) & (self.points.datetime <= params['end_date'])]
+        return selected.set_index('datetime')
+
+
+@pytest.fixture(scope = 'module')
+def readers(tmp_path_factory):
+    database = StubReader()
+    cube = GfasCubeReader(cube_folder = tmp_path_factory.mktemp('cube'))
+    cube.build_from_reader(database, TABLE, '2021-12-20', '2022-01-10')
+    parquet = GfasParquetReader(parquet_folder = tmp_path_factory.mktemp('parquet'), spatial = False)
+    parquet.export_from_reader(database, TABLE, '2021-12-20', '2022-01-10')
+    # one query per month for each copy
+    assert database.queries == 4
+    return cube, parquet
+
+
+@pytest.mark.parametrize('agg_operation', ['sum', 'mean', 'median', 'std', 'min', 'max'])
+def test_extract_data2_same_as_cube(readers, agg_operation):
+    cube, parquet = readers
+    expected = cube.extract_data2('2021-12-25', '2022-01-05', POLYGON, TABLE, agg_operation)
+    result = parquet.extract_data2('2021-12-25', '2022-01-05', POLYGON, TABLE, agg_operation)
+    assert len(result) == 12
+    pd.testing.assert_frame_equal(result, expected, check_freq = False, check_index_type = False, rtol = 1e-5)
+
+
+def test_spatial_extension_same_selection(readers):
+    # with the 'spatial' extension (if installed) the containment is computed in DuckDB, never downloaded here
+    cube, parquet = readers
+    spatial = GfasParquetReader(parquet_folder = parquet.parquet_folder)
+    expected = cube.extract_data2('2021-12-20', '2022-01-10', POLYGON, TABLE, 'sum')
+    result = spatial.extract_data2('2021-12-20', '2022-01-10', POLYGON, TABLE, 'sum')
+    pd.testing.assert_frame_equal(result, expected, check_freq = False, check_index_type = False, rtol = 1e-5)
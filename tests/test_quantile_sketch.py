@@ -0,0 +1,81 @@
+import mapclassify as mc
+import numpy as np
+import pytest
+
+from emission_explorer.QuantileSketch import QuantileSketch
+
+K = 10
+
+
+def rank_interval(values, x):
+    """Fractions of 'values' strictly below and below or equal to 'x'"""
+    values = np.sort(values)
+    return (np.searchsorted(values, x, side = 'left') / len(values),
+            np.searchsorted(values, x, side = 'right') / len(values))
+
+
+def assert_bins_close(sketch, values, k = K):
+    """Every class bound of the sketch and of mapclassify.Quantiles has a rank within the sketch error of i/k"""
+    eps = sketch.rank_error() + 1/len(values)
+    quantiles = np.arange(1, k + 1) / k
+    expected = mc.Quantiles(values, k = k).bins
+    # mapclassify uses the interpolated percentiles (then drops the repeated bounds)
+    mc_bounds = np.percentile(values, quantiles*100)
+    np.testing.assert_allclose(expected, np.unique(mc_bounds), rtol = 1e-9)
+    for q, approx, exact in zip(quantiles, sketch.quantile(quantiles), mc_bounds):
+        for bound in [approx, exact]:
+            below, below_or_equal = rank_interval(values, bound)
+            assert below - eps <= q <= below_or_equal + eps
+    bins = sketch.bins(k)
+    assert np.array_equal(bins, np.unique(sketch.quantile(quantiles)))
+    assert bins[-1] == expected[-1] == values.max()
+    assert len(bins) <= k
+
+
+@pytest.fixture
+def values():
+    return np.random.default_rng(0).lognormal(0, 2, 300000)
+
+
+def test_exact_below_k():
+    values = np.random.default_rng(1).random(500)
+    sketch = QuantileSketch.from_values(values, k = 1000)
+    assert sketch.rank_error() == 0
+    assert_bins_close(sketch, values)
+
+
+def test_streamed(values):
+    sketch = QuantileSketch(k = 1000)
+    for day in np.array_split(values, 365):
+        sketch.update(day)
+    assert len(sketch) == len(values)
+    assert 0 < sketch.rank_error() < 0.01
+    assert_bins_close(sketch, values)
+
+
+def test_merged(values):
+    first = QuantileSketch.from_values(values[:100000], chunk_size = 5000)
+    second = QuantileSketch.from_values(values[100000:], chunk_size = 7000)
+    merged = first.merge(second)
+    assert len(merged) == len(values)
+    assert_bins_close(merged, values)
+
+
+@pytest.mark.filterwarnings('ignore:Not enough unique values')
+def test_heavy_ties():
+    rng = np.random.default_rng(2)
+    values = np.concatenate([np.zeros(200000), rng.integers(1, 4, 50000).astype(float), rng.random(1000)*100])
+    rng.shuffle(values)
+    sketch = QuantileSketch(k = 500)
+    for chunk in np.array_split(values, 100):
+        sketch.update(chunk)
+    assert_bins_close(sketch, values)
+    # the repeated bounds collapse as in mapclassify, to the same classes
+    assert len(sketch.bins(K)) < K
+    np.testing.assert_array_equal(sketch.bins(K), mc.Quantiles(values, k = K).bins)
+
+
+def test_non_finite_values_are_ignored():
+    sketch = QuantileSketch.from_values(np.array([1.0, np.nan, 2.0, np.inf, 3.0]))
+    assert len(sketch) == 3
+    assert sketch.bins(3).tolist() == [1.0, 2.0, 3.0]
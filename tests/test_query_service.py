@@ -0,0 +1,167 @@
+import asyncio
+import json
+import threading
+import time
+
+import geopandas as gpd
+import matplotlib
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+matplotlib.use('Agg')
+
+from emission_explorer import data_handler
+from emission_explorer.GfasActivityReader import GfasReaderBase
+from emission_explorer.QueryService import QueryService
+
+PAYLOAD = dict(variable = 'Wildfire radiative power', geometry = ['Testland'], plot_type = 'Line Plot',
+               aggregating_operation = 'sum', resolution = 'daily',
+               specific_start_date = '01-06-2022', specific_end_date = '10-06-2022',
+               reference_start_date = '', reference_end_date = '')
+
+
+class StubReader(GfasReaderBase):
+    """Reader of a constant value per day, slow enough for the identical requests to overlap"""
+    delay = 0.3
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def extract_data2(self, start_date, end_date, polygon, table_name, agg_operation = None):
+        with self.calls['lock']:
+            self.calls['extract_data2'].append((table_name, agg_operation))
+        time.sleep(self.delay)
+        index = pd.date_range(start_date, end_date, name = 'datetime')
+        return pd.DataFrame({'sum': 2.0}, index = index)
+
+
+@pytest.fixture
+def service(monkeypatch):
+    # country shapes without downloading them
+    boundaries = gpd.GeoDataFrame({'continent': ['Test']}, geometry = [box(0, 0, 1, 1)], index = ['Testland'])
+    monkeypatch.setattr(data_handler, 'load_boundaries', lambda file_path_location = None: boundaries)
+    calls = dict(extract_data2 = [], lock = threading.Lock())
+    service = QueryService(reader_factory = lambda: StubReader(calls))
+    service.calls = calls
+    yield service
+    service.executor.shutdown()
+
+
+def post(service, path, payload):
+    return service.handle('POST', path, json.dumps(payload).encode())
+
+
+def test_data(service):
+    status, content_type, content, headers = asyncio.run(post(service, '/data', PAYLOAD))
+    assert (status, content_type, headers) == (200, 'application/json', {})
+    data = json.loads(content)['Testland']['Wildfire radiative power']
+    assert len(data['index']) == 10
+    assert all(row == [2.0] for row in data['data'])
+    assert len(service.calls['extract_data2']) == 1
+
+
+def test_data_csv(service):
+    status, content_type, content, _ = asyncio.run(post(service, '/data', dict(PAYLOAD, format = 'csv')))
+    assert (status, content_type) == (200, 'text/csv')
+    assert len(content.decode().strip().splitlines()) == 11
+
+
+def test_plot(service):
+    # the line plot shows the quantiles of the reference period
+    payload = dict(PAYLOAD, reference_start_date = '01-06-2020', reference_end_date = '10-06-2021', dpi = 50)
+    status, content_type, content, _ = asyncio.run(post(service, '/plot', payload))
+    assert (status, content_type) == (200, 'image/png')
+    assert content.startswith(b'\x89PNG')
+    assert len(service.calls['extract_data2']) == 2
+
+
+def test_identical_requests_are_coalesced(service):
+    async def both():
+        return await asyncio.gather(post(service, '/data', PAYLOAD), post(service, '/data', PAYLOAD))
+
+    first, second = asyncio.run(both())
+    assert first == second
+    assert service.stats['coalesced'] == 1
+    assert len(service.calls['extract_data2']) == 1
+    # later requests are answered by the result cache
+    asyncio.run(post(service, '/data', PAYLOAD))
+    assert len(service.calls['extract_data2']) == 1
+
+
+@pytest.mark.parametrize('key, value', [('database_url', 'postgresql://elsewhere/db'), ('backend', 'parquet'),
+                                        ('parquet_folder', '/tmp'), ('output_folder', '/tmp'),
+                                        ('incremental', True), ('diagnostics', True)])
+def test_payload_cannot_set_source_or_outputs(service, key, value):
+    with pytest.raises(ValueError, match = key):
+        asyncio.run(post(service, '/data', dict(PAYLOAD, **{key: value})))
+    assert service.calls['extract_data2'] == []
+
+
+def test_running_exact_query_preview_is_reused(service):
+    # a previous request returned a preview, its exact query still runs in the background
+    config = dict(PAYLOAD, geometry = box(0, 0, 1, 1), **service.source_config)
+    qd = data_handler.query_data(config, db = StubReader(service.calls), run_query = False)
+    qd.data = pd.DataFrame({'sum': 1.0}, index = pd.date_range('2022-06-01', '2022-06-10', name = 'datetime'))
+    qd.preview = dict(sample_percent = 1, relative_error = 0.05)
+    done = threading.Event()
+    qd.exact = threading.Thread(target = done.wait, daemon = True)
+    qd.exact.start()
+    service.running[service.config_hash(PAYLOAD)] = [qd]
+    try:
+        status, _, content, headers = asyncio.run(post(service, '/data', PAYLOAD))
+    finally:
+        done.set()
+    assert status == 200
+    assert headers == {'X-Preview': 'sample_percent=1; total_relative_error=0.05'}
+    assert all(row == [1.0] for row in json.loads(content)['Testland']['Wildfire radiative power']['data'])
+    assert service.calls['extract_data2'] == []
+
+
+class StubWriter(object):
+    def __init__(self):
+        self.content = b''
+
+    def write(self, data):
+        self.content += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def send(service, request):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(request)
+        reader.feed_eof()
+        writer = StubWriter()
+        await service.handle_connection(reader, writer)
+        return writer.content
+    return asyncio.run(run())
+
+
+def http_post(path, payload):
+    body = json.dumps(payload).encode()
+    return f'POST {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body
+
+
+def test_http_status(service, monkeypatch):
+    assert send(service, http_post('/data', PAYLOAD)).startswith(b'HTTP/1.1 200 OK')
+    # malformed requests and payloads
+    assert send(service, b'GARBAGE\r\n\r\n').startswith(b'HTTP/1.1 400 Bad Request')
+    assert send(service, b'POST /data HTTP/1.1\r\nno header\r\n\r\n').startswith(b'HTTP/1.1 400 Bad Request')
+    assert send(service, http_post('/data', dict(PAYLOAD, output_folder = '/tmp'))).startswith(b'HTTP/1.1 400 Bad Request')
+    assert send(service, http_post('/data', {'variable': 'Wildfire radiative power'})).startswith(b'HTTP/1.1 400 Bad Request')
+    # failures of the queries
+    def over_budget(*args, **kwargs):
+        raise TimeoutError('The latency budget is over.')
+    monkeypatch.setattr(StubReader, 'extract_data2', over_budget)
+    assert send(service, http_post('/data', dict(PAYLOAD, aggregating_operation = 'max'))).startswith(b'HTTP/1.1 504 Gateway Timeout')
+    def broken(*args, **kwargs):
+        raise RuntimeError('server closed the connection')
+    monkeypatch.setattr(StubReader, 'extract_data2', broken)
+    assert send(service, http_post('/data', dict(PAYLOAD, aggregating_operation = 'min'))).startswith(b'HTTP/1.1 500 Internal Server Error')
+    assert service.stats['errors'] == 6